@@ -1,89 +1,265 @@
+import importlib
+import json
+import math
 import os
-from dotenv import load_dotenv
-from google.api_core.exceptions import InternalServerError
+import re
+import threading
 import time
-from functools import wraps
+from typing import Union
+from dotenv import load_dotenv
 
+import AdmissionProcessor
+import AnnIndexProcessor
+import AnswerCacheProcessor
+import ChatHistoryProcessor
+import ChatSessionProcessor
+from ChatSessionProcessor import DEFAULT_SESSION, ChatSession
+import EmbeddingProcessor
 import LawDataProcessor
-from LawDataProcessor import load_data, save_data, Article
+import LexicalIndexProcessor
+import LLMClientProcessor
+import MetricsProcessor
+import RetrievalProcessor
+from LawDataProcessor import get_law, Article
 from LawDataProcessor import LawData
+import ModelProviderProcessor
 import numpy as np
-import pandas as pd
-import google.generativeai as genai
-import google.ai.generativelanguage as glm
 
 load_dotenv()
 
-KEY = os.getenv('GOOGLE_API_KEY')
-genai.configure(api_key=KEY)
-emb_model = 'models/embedding-001'
-gen_model = genai.GenerativeModel('gemini-1.0-pro')
-chat = gen_model.start_chat(history=[])
-chat_started = False
-cur_related_articles = None
-retry_counter = 0
-
-
-def retry_function(func):
-    @wraps(func)
-    def warp_func(*args, **kargs):
-        for _ in range(3):
-            try:
-                func_result = func(*args, **kargs)
-            except Exception as e:
-                print("Retry [function: {}], {}".format(
-                       func.__name__, e))
-                time.sleep(1)
-            else:
-                return func_result
-        else:
-            raise Exception("Retry timeout")
-    return warp_func
+# 模型、嵌入快取等在第一次使用時才建立，匯入本模組不連線也不開檔，伺服器可以很快開始服務
+provider = None  # 環境變數MODEL_PROVIDER: gemini/fake/record/replay
+embedding_cache = None
+_init_lock = threading.Lock()
+session_manager = ChatSessionProcessor.ChatSessionManager(
+    idle_timeout=float(os.getenv("CHAT_SESSION_IDLE_TIMEOUT", "1800")),
+    max_sessions=int(os.getenv("CHAT_MAX_SESSIONS", "1000")))
+llm_client = LLMClientProcessor.LLMClient(
+    requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", "60")),
+    tokens_per_minute=float(os.getenv("LLM_TOKENS_PER_MINUTE", "1000000")),
+    deadline=float(os.getenv("LLM_CALL_DEADLINE", "60")))
+admission = AdmissionProcessor.AdmissionController(
+    max_concurrency=int(os.getenv("CHAT_MAX_CONCURRENCY", "4")),
+    max_queue=int(os.getenv("CHAT_MAX_QUEUE", "16")),
+    queue_timeout=float(os.getenv("CHAT_QUEUE_TIMEOUT", "60")),
+    user_requests_per_minute=float(os.getenv("CHAT_USER_REQUESTS_PER_MINUTE", "10")))
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))  # start_chat系統提示(含條文)的token上限
+answer_cache = AnswerCacheProcessor.SemanticAnswerCache(
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "86400")),
+    max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1024")))
+history_store = ChatHistoryProcessor.ChatHistoryStore(
+    root=os.getenv("CHAT_HISTORY_DIR", ChatHistoryProcessor.CHAT_HISTORY_DIR))
+resume_turns = int(os.getenv("CHAT_RESUME_TURNS", "10"))  # 重新開啟頁面時載入的最近回合數
+chat_window_turns = int(os.getenv("CHAT_WINDOW_TURNS", "10"))  # 送給模型的對話回合數上限(不含系統資訊)
+# 條文嵌入的檢索方式: none(float32)/int8/binary，量化時先以量化矩陣挑選 top_k * rescore_factor 個候選再以float32重新計分
+embedding_quantization = os.getenv("EMBEDDING_QUANTIZATION", "none")
+rescore_factor = int(os.getenv("EMBEDDING_RESCORE_FACTOR", "4"))
+# BM25前router_bm25_top_k條的分數有此比例以上集中在民法同一編、且最高分不低於ROUTER_BM25_MIN_SCORE時，不呼叫LLM分類；大於1時停用
+# 略過LLM分類也就略過了是否為民法問題的判斷，預設停用，以實際的民法問題調整門檻後再開啟(例如0.8)
+router_bm25_confidence = float(os.getenv("ROUTER_BM25_CONFIDENCE", "1.1"))
+router_bm25_min_score = float(os.getenv("ROUTER_BM25_MIN_SCORE", "10"))
+router_bm25_top_k = 10
+ann_nprobe = int(os.getenv("ANN_NPROBE", "8"))  # 全語料檢索每次搜尋的清單數，越大召回率越高、越慢
+_ann_index = None
+_ann_lock = threading.Lock()
+DEFAULT_PREWARM_LAWS = "民法,民法總則施行法,民法債編施行法,民法物權編施行法,民法親屬編施行法,民法繼承編施行法"
+_readiness = {"state": "cold", "seconds": None, "laws": {}, "errors": []}
+_prewarm_thread = None
+
+
+def _cache_stats() -> dict:
+    stats = {"answer": answer_cache.stats(), "law_registry": LawDataProcessor.law_registry.stats()}
+    if embedding_cache is not None:
+        stats["embedding"] = embedding_cache.stats()
+    return stats
+
+
+MetricsProcessor.registry.gauge(
+    "lawchat_cache_hit_ratio", "快取命中率",
+    lambda: {(("cache", name),): s["hit_rate"] for name, s in _cache_stats().items()})
+MetricsProcessor.registry.gauge(
+    "lawchat_llm_events", "模型呼叫累計次數(呼叫、重試、失敗、被拒絕)",
+    lambda: {(("event", k),): v for k, v in llm_client.stats().items() if k != "circuit"})
+MetricsProcessor.registry.gauge(
+    "lawchat_llm_circuit_open", "斷路器是否開啟",
+    lambda: 0 if llm_client.breaker.state == llm_client.breaker.CLOSED else 1)
+MetricsProcessor.registry.gauge("lawchat_chat_sessions", "進行中的對話數", lambda: len(session_manager))
+MetricsProcessor.registry.gauge(
+    "lawchat_admission", "對話受理狀態(執行中、排隊中及累計的受理、拒絕、超過配額、逾時數)",
+    lambda: {(("state", k),): v for k, v in admission.stats().items() if k != "service_seconds"})
+
+
+def get_provider() -> ModelProviderProcessor.ModelProvider:
+    global provider
+    if provider is None:
+        with _init_lock:
+            if provider is None:
+                provider = ModelProviderProcessor.create_provider()
+    return provider
+
+
+def get_embedding_cache() -> EmbeddingProcessor.EmbeddingCache:
+    global embedding_cache
+    if embedding_cache is None:
+        with _init_lock:
+            if embedding_cache is None:
+                embedding_cache = EmbeddingProcessor.EmbeddingCache()
+    return embedding_cache
+
+
+def generate(prompt, temperature: float, stream: bool = False):
+    """經由llm_client呼叫模型生成"""
+    tokens = RetrievalProcessor.estimate_tokens(prompt)
+    with MetricsProcessor.span("llm_call", call="generate", prompt_tokens=tokens) as span:
+        response = llm_client.call(get_provider().generate, prompt, temperature, stream=stream, tokens=tokens)
+        span.set(retries=llm_client.last_retries())
+        if not stream:
+            span.set(response_tokens=RetrievalProcessor.estimate_tokens(response.text))
+        return response
+
+
+def send_message(session: ChatSession, prompt, temperature: float, stream: bool = False):
+    """經由llm_client在session的對話中送出訊息，token數包含會被重送的對話紀錄"""
+    tokens = RetrievalProcessor.estimate_tokens(prompt)
+    with MetricsProcessor.span("llm_call", call="chat", prompt_tokens=session.context_tokens + tokens) as span:
+        response = llm_client.call(session.chat.send_message, prompt, temperature, stream=stream,
+                                   tokens=session.context_tokens + tokens)
+        span.set(retries=llm_client.last_retries())
+        if not stream:
+            span.set(response_tokens=RetrievalProcessor.estimate_tokens(response.text))
+    session.context_tokens += tokens
+    return response
+
+
+def embedding_all_articles(law_df: LawData, update_ann: bool = True, data_dir: str = LawDataProcessor.DATA_DIR):
+    """
+    批次、並行嵌入所有條文，中途失敗可從檢查點續傳，完成後儲存到data_dir
+    :param update_ann: 是否更新並儲存全語料的ANN索引(會重寫整個索引檔)；大量匯入時設為False，最後再重建一次
+    """
+    EmbeddingProcessor.ingest_embeddings(law_df, ModelProviderProcessor.ProviderEmbedder(get_provider(), client=llm_client),
+                                         data_dir=data_dir)
+    if not update_ann:
+        return
+    index = get_ann_index()
+    if index is not None:
+        index.replace_law(law_df)
+        index.save(AnnIndexProcessor.ANN_INDEX_PATH)
+
+
+def get_ann_index():
+    """載入全語料的ANN索引(python AnnIndexProcessor.py 建立)，沒有索引檔時回傳None"""
+    global _ann_index
+    if _ann_index is None and os.path.exists(AnnIndexProcessor.ANN_INDEX_PATH):
+        with _ann_lock:
+            if _ann_index is None:
+                _ann_index = AnnIndexProcessor.IVFIndex.load(AnnIndexProcessor.ANN_INDEX_PATH)
+                _ann_index.nprobe = ann_nprobe
+    return _ann_index
+
+
+def search_all_laws(query, max_rows=10, nprobe: int = None) -> list[tuple[str, str, float]]:
+    """
+    在所有已嵌入的法律中檢索
+    :param nprobe: 搜尋的清單數，None時使用ANN_NPROBE
+    :return: [(法律名稱, 條號, 點積值), ...]，沒有ANN索引時回傳空清單
+    """
+    index = get_ann_index()
+    if index is None:
+        return []
+    return index.search(embed_query(query), max_rows, nprobe)
+
 
+def embed_queries(texts: list[str], task_type: str = "retrieval_query") -> list[np.ndarray]:
+    """批次取得查詢字串的嵌入向量，先查embedding_cache，未命中的一次送出"""
+    def embed_func(missing):
+        return llm_client.call(get_provider().embed, missing, task_type,
+                               tokens=sum(len(t) for t in missing))
+    return get_embedding_cache().get_or_embed(texts, embed_func, get_provider().embedding_model, task_type)
 
-def embedding_all_articles(law_df: LawData):
-    global emb_model
-    for article in law_df.law_articles:
-        article.article_embedding = genai.embed_content(model=emb_model,
-                                                        content=article.article_content,
-                                                        task_type="retrieval_document",
-                                                        title=article.get_article_title(law_df.get_law_name())
-                                                        )['embedding']
-    save_data(law_df)
+
+def embed_query(text: str, task_type: str = "retrieval_query") -> np.ndarray:
+    return embed_queries([text], task_type)[0]
 
 
 def get_dot_product(qstr, label_str, q_embedding=None):
     if q_embedding is None:
-        query_embedding = genai.embed_content(model=emb_model,
-                                              content=qstr,
-                                              task_type="retrieval_query")["embedding"]
+        query_embedding = embed_query(qstr)
     else:
         query_embedding = q_embedding
-    lb_embedding = genai.embed_content(model=emb_model,
-                                       content=label_str,
-                                       task_type="retrieval_query")["embedding"]
+    lb_embedding = embed_query(label_str)
     return np.dot(query_embedding, lb_embedding)
 
 
-def get_pd_dataframe_with_dot_products(query, dataframe: LawData):
+def get_pd_dataframe_with_dot_products(query, dataframe: LawData, fusion: bool = False, rrf_k: int = 60):
     """
   Compute the distances between the query and each document in the dataframe
-  using the dot product.
+  using the dot product (on L2-normalized embeddings).
+  fusion=True時另外加上BM25分數(bm25_scores)及兩者倒數排名融合的分數(rrf_scores)，並依rrf_scores排序
   """
-    query_embedding = genai.embed_content(model=emb_model,
-                                          content=query,
-                                          task_type="retrieval_query")
-    data_embeddings = []
-    _temp = pd.DataFrame({'article_names': [],
-                          'article_contents': []})
-    for e in dataframe.law_articles:
-        data_embeddings.append(e.article_embedding)
-        new_row = [e.get_article_title(dataframe.get_law_name()), e.article_content]
-        _temp.loc[len(_temp)] = new_row
-    dot_products = np.dot(np.stack(data_embeddings), query_embedding["embedding"])
-    _temp = _temp.assign(dot_products=dot_products.tolist())
-    _temp.sort_values('dot_products', ascending=False, inplace=True)
-    return _temp  # Return pd DataFrame of Law Data With dot Products
+    import pandas as pd  # pandas匯入較慢，只在需要時載入
+    query_embedding = embed_query(query)
+    result = RetrievalProcessor.search_laws(query_embedding, dataframe, top_k=None,
+                                            quantization=embedding_quantization)
+    if not fusion:
+        return pd.DataFrame({'article_names': result.titles(),
+                             'article_contents': [a.article_content for a in result.articles],
+                             'dot_products': result.scores.tolist()})  # Return pd DataFrame of Law Data With dot Products
+    lexical = LexicalIndexProcessor.search_lexical(query, dataframe, top_k=None)
+    fused = LexicalIndexProcessor.reciprocal_rank_fusion([result.articles, lexical.articles], k=rrf_k)
+    dots = {id(a): s for a, s in result}
+    bm25 = {id(a): s for a, s in lexical}
+    return pd.DataFrame({'article_names': fused.titles(),
+                         'article_contents': [a.article_content for a in fused.articles],
+                         'dot_products': [dots.get(id(a), 0.0) for a in fused.articles],
+                         'bm25_scores': [bm25.get(id(a), 0.0) for a in fused.articles],
+                         'rrf_scores': fused.scores.tolist()})
+
+
+def search_related_articles(query, laws: list[LawData], threshold: float = 0.7, max_rows=100):
+    """
+    以預先正規化的嵌入矩陣檢索最相關的條文
+    :param query: 問題
+    :param laws: 要檢索的法律，可同時檢索多部
+    :param threshold: 閾值應屆於0到1之間，表示代表相關度的點積值最低應高於此值，預設為0.7
+    :param max_rows: 指定資料數最多幾條，預設為100
+    :return: RetrievalProcessor.RetrievalResult，依相關度排序
+    """
+    query_embedding = embed_query(query)
+    return RetrievalProcessor.search_laws(query_embedding, laws, top_k=max_rows, threshold=threshold,
+                                          quantization=embedding_quantization, rescore_factor=rescore_factor)
+
+
+def hybrid_search_articles(query, laws: list[LawData], max_rows=100, lexical_rows=200, rrf_k: int = 60):
+    """
+    BM25與嵌入檢索的倒數排名融合
+    BM25只在本地計算；嵌入檢索無法使用時(斷路器開啟、速率限制逾時、重試後仍失敗)只回傳BM25的結果
+    :param lexical_rows: BM25取前幾條參與融合
+    :return: RetrievalProcessor.RetrievalResult，scores為RRF分數
+    """
+    lexical = LexicalIndexProcessor.search_lexical(query, laws, top_k=lexical_rows)
+    try:
+        dense = search_related_articles(query, laws, threshold=None, max_rows=max_rows)
+    except (LLMClientProcessor.CircuitOpenError, LLMClientProcessor.RateLimitTimeout,
+            *LLMClientProcessor.RETRYABLE_ERRORS) as e:
+        print("嵌入檢索無法使用，只使用BM25: {}".format(e))
+        return RetrievalProcessor.RetrievalResult(lexical.articles[:max_rows], lexical.scores[:max_rows])
+    return LexicalIndexProcessor.reciprocal_rank_fusion([dense.articles, lexical.articles], k=rrf_k,
+                                                        top_k=max_rows)
+
+
+def rank_articles(query, articles: list[Article]) -> list[Article]:
+    """
+    以hybrid_search_articles排序候選條文(例如選定的編及施行法)，不在融合結果中的條文不列入
+    """
+    law_names = []
+    for a in articles:
+        if a is not None and a.article_law_name not in law_names:
+            law_names.append(a.article_law_name)
+    laws = [law for law in (_load_law(name) for name in law_names) if law is not None]
+    fused = hybrid_search_articles(query, laws, max_rows=len(articles), lexical_rows=len(articles))
+    candidates = {id(a) for a in articles if a is not None}
+    return [a for a in fused.articles if id(a) in candidates]
 
 
 def find_related_articles(dataframe, threshold: float = 0.7, max_rows=100):
@@ -111,82 +287,156 @@ def find_most_related_label(qstr, labels: list[str]):
     """
     if len(labels) == 0:
         return None
-    max_dot = -1
-    related_label = ""
-    q_embedding = genai.embed_content(model=emb_model,
-                                      content=qstr,
-                                      task_type="retrieval_query")["embedding"]
-    for s in labels:
-        dot = get_dot_product("", s, q_embedding)
-        if dot is not None and dot > max_dot:
-            max_dot = dot
-            related_label = s
-    return related_label
+    embeddings = embed_queries([qstr] + list(labels))
+    dots = np.stack(embeddings[1:]) @ embeddings[0]
+    return labels[int(np.argmax(dots))]
 
 
-def gemini_answer(q_str, articles: list[Article]):
+def _answer_prompt(q_str, articles: list[Article]):
+    """回傳 (提示, 溫度)"""
     data_str = ""
-    response = None
     if articles is not None and len(articles) != 0:
         for a in articles:
             data_str += a.article_law_name + a.article_number + " " + a.article_content + "\n"
         prompt = (
                 "重要:以中文回答\n你是一個的法律顧問，你會從提示中給予的法律條文資料作為回答的參考來源，進行擬人化的回答，回答內容應盡可能豐富，並且易於理解，並以舉例方式說明\n法律條文資料:" + data_str
                 + "\n問題:" + q_str)
-        response = gen_model.generate_content(prompt,
-                                              generation_config=genai.types.GenerationConfig(
-                                                  temperature=0.8),
-                                              )
+        return prompt, 0.8
     else:
         prompt = "重要:以中文回答\n生成一個委婉地、擬人化的、真實的語句，表達以下意思:您的問題或許不在民法的範疇內所以我無法回答。"
-        response = gen_model.generate_content(prompt,
-                                              generation_config=genai.types.GenerationConfig(
-                                                  temperature=0.9)
-                                              )
-
-    return response.text.replace('•', '  *').replace(".", ". ")
-
-
-def civil_code_analyze(qstr, table):
-    prompt = "問題:\n" + qstr + "\n以上問題是否是民法相關?\n輸出格式:是/否"
-    is_law_q = gen_model.generate_content(prompt,
-                                          generation_config=genai.types.GenerationConfig(
-                                              temperature=0.0)
-                                          ).text
-    # print(is_law_q)
-    if "是" in is_law_q:
-        prompt = "問題:\n" + qstr + "\n以上問題中是否是指定第幾條法條的問題?\n輸出格式:是/否"
-        ask_specific_article = gen_model.generate_content(prompt,
-                                                          generation_config=genai.types.GenerationConfig(
-                                                              temperature=0.0)
-                                                          ).text
-        # print(ask_specific_article)
-        if "是" in ask_specific_article:
-            prompt = "問題:\n" + qstr + "\n以上問題的指定法條是幾號?\n範例輸入:民法第123-1號及145號 範例輸出:N123-1\nN145"
-            article_num = gen_model.generate_content(prompt,
-                                                     generation_config=genai.types.GenerationConfig(
-                                                         temperature=0.0)
-                                                     ).text
-            print("[civil_code_analyze]:" + article_num)
-            return article_num
-        else:
-            prompt = "目錄:\n" + table + "\n" + "以下問題的答案最可能出現在那幾編\n" + qstr + (
-                "\n輸出格式:C第X編 XXX\nC第X編 XXX")
-            response = gen_model.generate_content(prompt,
-                                                  generation_config=genai.types.GenerationConfig(
-                                                      temperature=0.0)
-                                                  )
-        print("[civil_code_analyze]:" + response.text)
-        return response.text
-    else:
+        return prompt, 0.9
+
+
+def format_answer(text: str) -> str:
+    """回答的顯示格式"""
+    return text.replace('•', '  *').replace(".", ". ")
+
+
+def gemini_answer(q_str, articles: list[Article]):
+    prompt, temperature = _answer_prompt(q_str, articles)
+    response = generate(prompt, temperature)
+    return format_answer(response.text)
+
+
+_OTHER_LAW_REFERENCE = re.compile(r"[\u4e00-\u9fff]{1,20}(法|條例|規則|辦法|細則)\s*第")
+
+
+def route_article_references(qstr, law: LawData = None) -> Union[list[str], None]:
+    """
+    本地解析問題中指定的民法條號，不呼叫LLM
+    :param law: 指定時只保留這部法律中存在的條號
+    :return: 條號清單，問題沒有指定(存在的)條號或提到民法以外的法律時回傳None
+    """
+    if _OTHER_LAW_REFERENCE.search(qstr.replace("民法", "")) is not None:
+        return None
+    refs = LawDataProcessor.parse_article_references(qstr)
+    if law is not None:
+        refs = [r for r in refs if law.get_article_by_num(r) is not None]
+    return refs if len(refs) != 0 else None
+
+
+def route_by_lexical(qstr, law: LawData) -> Union[str, None]:
+    """
+    本地以BM25判斷問題集中在民法的哪一編，不呼叫LLM
+    :return: 編的標題(例如"第二編 債")，不夠確定或提到民法以外的法律時回傳None
+    """
+    if router_bm25_confidence > 1 or _OTHER_LAW_REFERENCE.search(qstr.replace("民法", "")) is not None:
+        return None
+    scores = LexicalIndexProcessor.get_lexical_index(law).scores(qstr)
+    rows = RetrievalProcessor.select_top_k(scores, router_bm25_top_k, threshold=1e-9)
+    if len(rows) == 0 or scores[rows[0]] < router_bm25_min_score:
+        return None
+    totals = {}
+    for heading, score in zip(law.get_part_headings(rows.tolist()), scores[rows].tolist()):
+        totals[heading] = totals.get(heading, 0.0) + score
+    heading, best = max(totals.items(), key=lambda t: t[1])
+    if heading == "" or best < router_bm25_confidence * sum(totals.values()):
+        return None
+    return heading
+
+
+def _parse_router_response(text: str) -> Union[dict, None]:
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if match is None:
+        return None
+    try:
+        result = json.loads(match.group())
+    except json.JSONDecodeError:
+        return None
+    return result if isinstance(result, dict) else None
+
+
+def civil_code_analyze(qstr, table, law: LawData = None):
+    """
+    判斷問題是否與民法相關，並找出指定的條號或最相關的編
+    先以本地解析處理指定條號的問題，再以BM25判斷是否明確集中在某一編，其餘以一次LLM呼叫同時取得分類、條號及編
+    :param law: 民法，指定時不存在的條號不列入，沒有存在的條號時改用LLM分類或編
+    :return: "N123-1\nN145" 形式的條號、"C第X編 XXX\nC第X編 XXX" 形式的編，或非民法問題時回傳None
+    """
+    with MetricsProcessor.span("classify") as span:
+        result = _classify(qstr, table, law)
+        span.set(result=result)
+        return result
+
+
+def _classify(qstr, table, law: LawData = None):
+    refs = route_article_references(qstr, law)
+    if refs is not None:
+        return "\n".join("N" + r for r in refs)
+    if law is not None:
+        heading = route_by_lexical(qstr, law)
+        if heading is not None:
+            return "C" + heading
+    prompt = ("目錄:\n" + table + "\n"
+              + "問題:\n" + qstr + "\n"
+              + "請判斷以上問題是否是民法相關；如果問題指定了第幾條法條，列出條號；否則列出答案最可能出現在目錄中的那幾編\n"
+              + '只輸出JSON，格式:{"civil": true, "articles": ["123-1", "145"], "chapters": ["第X編 XXX"]}\n'
+              + '非民法問題輸出:{"civil": false, "articles": [], "chapters": []}')
+    response = generate(prompt, 0.0).text
+    route = _parse_router_response(response)
+    if route is None or not route.get("civil"):
         return None
+    articles = [LawDataProcessor.normalize_article_number(str(a)) for a in route.get("articles") or []]
+    articles = [a for a in articles if a != "" and (law is None or law.get_article_by_num(a) is not None)]
+    if len(articles) != 0:
+        result = "\n".join("N" + a for a in articles)
+    else:
+        chapters = [str(c).strip() for c in route.get("chapters") or [] if str(c).strip() != ""]
+        if len(chapters) == 0:
+            chapters = ["第一編 總則"]
+        result = "\n".join("C" + c for c in chapters)
+    return result
+
+
+def _load_law(law_name: str):
+    with MetricsProcessor.span("law_load", law=law_name):
+        return get_law(law_name)
+
+
+def _load_civil_code() -> LawData:
+    """取得民法，尚未匯入時拋出LawNotIngested(問題的分類及選編都依據民法，沒有民法無法回答)"""
+    civil_code = _load_law("民法")
+    if civil_code is None:
+        raise LawDataProcessor.LawNotIngested("民法")
+    return civil_code
 
 
 def find_related_laws(qstr):
-    civil_code = load_data("民法")
-    cc_result = civil_code_analyze(qstr, civil_code.get_table_of_articles())
+    civil_code = _load_civil_code()
+    cc_result = civil_code_analyze(qstr, civil_code.get_table_of_articles(), civil_code)
+    return _related_articles(civil_code, cc_result)
+
+
+def _related_articles(civil_code: LawData, cc_result: Union[str, None]):
     if cc_result is None:
         return None
+    with MetricsProcessor.span("chapter_filter") as span:
+        articles = _filter_articles(civil_code, cc_result)
+        span.set(articles=len(articles or []))
+        return articles
+
+
+def _filter_articles(civil_code: LawData, cc_result: str):
     if "C" in cc_result:
         chapters = [["總則", "", "", ""]]
         chp_lst = cc_result.splitlines()
@@ -202,9 +452,11 @@ def find_related_laws(qstr):
         for t in tmp:
             other_law = ""
             if t == "總則":
-                other_law = load_data("民法總則施行法")
+                other_law = _load_law("民法總則施行法")
             else:
-                other_law = load_data("民法" + t + "編施行法")
+                other_law = _load_law("民法" + t + "編施行法")
+            if other_law is None:
+                continue
             for a in other_law.law_articles:
                 related_articles.append(a)
         return related_articles
@@ -212,22 +464,92 @@ def find_related_laws(qstr):
         articles = []
         arc_lst = cc_result.splitlines()
         for a in arc_lst:
-            articles.append(civil_code.get_article_by_num(a))
+            article = civil_code.get_article_by_num(a)
+            if article is not None:
+                articles.append(article)
         return articles
 
 
-def clean_chatbot():
-    global chat
-    chat = gen_model.start_chat(history=[])
-    global chat_started
-    chat_started = False
+def get_law_versions(law_names: list[str]) -> dict[str, str]:
+    """回傳各法律目前的LawModifiedDate"""
+    result = {}
+    for name in law_names:
+        law = get_law(name)
+        if law is None or law.law_modified_date is None:
+            result[name] = ""
+        else:
+            result[name] = law.law_modified_date.strftime("%Y%m%d")
+    return result
+
+
+def answer_question(q_str):
+    """
+    回答單一問題，先查詢相似問題的回答快取，未命中時才搜尋法條並產生回答
+    快取以問題指定的條號及分類結果一併比對，只差在條號的問題不會取得彼此的回答
+    民法尚未匯入時回傳說明訊息
+    :return: (回答, 相關條文)
+    """
+    with MetricsProcessor.trace("answer") as root:
+        try:
+            civil_code = _load_civil_code()
+        except LawDataProcessor.LawNotIngested as e:
+            return str(e), None
+        query_embedding = embed_query(q_str)
+        cc_result = civil_code_analyze(q_str, civil_code.get_table_of_articles(), civil_code)
+        route = (tuple(route_article_references(q_str, civil_code) or ()), cc_result)
+        cached = answer_cache.lookup(query_embedding, get_law_versions, route)
+        root.set(answer_cache_hit=cached is not None)
+        if cached is not None:
+            return cached.answer, cached.articles
+        related_articles = _related_articles(civil_code, cc_result)
+        answer = gemini_answer(q_str, related_articles)
+        law_names = {"民法"}  # 分類及選編都依據民法
+        for a in related_articles or []:
+            if a is not None:
+                law_names.add(a.article_law_name)
+        answer_cache.put(q_str, query_embedding, answer, related_articles, get_law_versions(sorted(law_names)),
+                         route)
+        return answer, related_articles
+
+
+def clean_chatbot(session_id: str = DEFAULT_SESSION):
+    session_manager.clear(session_id)
+
+
+def login_chat(session_id: str, account: str):
+    """
+    帳號登入後綁定到這個瀏覽器session並載入該帳號最近的對話
+    :return: 對話紀錄 [(問題, 回答), ...]
+    """
+    session_manager.set_account(session_id, account)
+    return resume_chat(session_id)
+
 
+def logout_chat(session_id: str):
+    session_manager.set_account(session_id, None)
 
-@retry_function
-def start_chat(qstr):
+
+def resume_chat(session_id: str = DEFAULT_SESSION):
+    """
+    載入登入帳號最近一次對話的最後resume_turns回合作為上下文，未登入時不載入
+    之後的對話寫入這個瀏覽器session自己的紀錄，不會寫進舊的紀錄
+    :return: 對話紀錄 [(問題, 回答), ...]
+    """
+    with session_manager.session(session_id) as session:
+        if session.started or len(session.history) != 0 or session.account is None:
+            return session.history
+        log_session = history_store.latest_session(session.account)
+        if log_session is not None:
+            session.history = history_store.load_recent(session.account, log_session, resume_turns)
+        return session.history
+
+
+def start_chat(qstr, session: ChatSession):
     articles = find_related_laws(qstr)
-    global chat
-    chat = gen_model.start_chat(history=[])
+    resumed, log_session = session.history, session.log_session
+    session.reset()
+    session.log_session = log_session or ChatHistoryProcessor.split_session_id(session.session_id)[1]
+    session.chat = get_provider().start_chat()
     prompt = ("這是系統資訊，會描述在接下來的對話中你所扮演的角色以及回答的規則\n"
               + "角色:你是一個法律顧問，但只回答民法相關問題\n"
               + "規則1.從<法律條文資料>作為回答\n"
@@ -239,50 +561,212 @@ def start_chat(qstr):
               + "規則7.回答後給予警示<因法律條文僅參考民法，可能有所謬誤，請斟酌參考>\n"
               + "規則8.回答禁止延伸到其他法律\n"
               + "\n<法律條文資料>:")
-    data_str = ""
-    if articles is not None and len(articles) != 0:
-        for a in articles:
-            data_str += a.article_law_name + a.article_number + " " + a.article_content + "\n"
-    else:
-        data_str = "無資料"
-
-    print(data_str)
-    prompt += data_str
-    print("[Tokens count]:" + str(gen_model.count_tokens(prompt)))
-    response = chat.send_message(prompt,
-                                 generation_config=genai.types.GenerationConfig(
-                                     temperature=0.9))
-    global chat_started
-    chat_started = True
-    global cur_related_articles
-    cur_related_articles = articles
+    with MetricsProcessor.span("prompt_assembly") as span:
+        data_str = ""
+        if articles is not None and len(articles) != 0:
+            budget = context_token_budget - RetrievalProcessor.estimate_tokens(prompt)
+            candidates = len(articles)
+            articles = RetrievalProcessor.pack_articles(articles, None, budget,
+                                                        ranking=lambda: rank_articles(qstr, articles))
+            span.set(candidates=candidates)
+            data_str = "".join(RetrievalProcessor.format_article(a) for a in articles)
+        else:
+            data_str = "無資料"
+        prompt += data_str
+        span.set(articles=len(articles or []), prompt_tokens=RetrievalProcessor.estimate_tokens(prompt))
+    response = send_message(session, prompt, 0.9)
+    session.context_tokens += RetrievalProcessor.estimate_tokens(response.text)
+    if len(resumed) != 0:  # 接續的回合放在系統資訊之後
+        messages = []
+        for question, answer in resumed:
+            messages += [get_provider().message("user", question), get_provider().message("model", answer)]
+            session.context_tokens += RetrievalProcessor.estimate_tokens(question + answer)
+        session.chat.history = list(session.chat.history) + messages
+        session.history = list(resumed)
+        _trim_window(session)
+    session.started = True
+    session.related_articles = articles
     return response.text
 
 
-def gemini_chat(qstr):
-    if not chat_started:
-        start_chat(qstr)
-    global chat
+def gemini_chat(qstr, session_id: str = DEFAULT_SESSION):
+    """
+    在session_id對應的對話中回答問題，不同session可並行，同一session依序執行
+    民法尚未匯入時回答為說明訊息，不記錄這一回合
+    :return: 這一回合的(問題, 回答)，完整的對話紀錄在session.history
+    """
+    with MetricsProcessor.trace("chat"), session_manager.session(session_id) as session:
+        try:
+            return _session_chat(qstr, session)
+        except LawDataProcessor.LawNotIngested as e:
+            return qstr, str(e)
+
+
+def gemini_chat_stream(qstr, session_id: str = DEFAULT_SESSION):
+    """
+    串流版的gemini_chat，第一次提問時仍會先完成start_chat
+    使用者中途離開(generator被關閉)或串流失敗時撤銷這一回合，模型的對話與保存的紀錄保持一致
+    民法尚未匯入時產生說明訊息後結束
+    :return: generator，每次產生目前為止的完整回答
+    """
+    # generator的每一步可能在不同的執行緒及context中執行，trace明確傳遞，不依賴跨越yield的contextvar
+    trace = MetricsProcessor.new_trace("chat_stream")
+    with MetricsProcessor.span("chat_stream", parent=trace), session_manager.session(session_id) as session:
+        messages = None
+        finished = False
+        try:
+            with MetricsProcessor.use_trace(trace):
+                if not session.started:
+                    start_chat(qstr, session)
+                messages, context_tokens = list(session.chat.history), session.context_tokens
+                response = send_message(session, qstr, 0.8, stream=True)
+            answer = ""
+            with MetricsProcessor.span("llm_stream", parent=trace) as span:
+                for chunk in response:
+                    answer += chunk.text
+                    yield answer
+                span.set(response_tokens=RetrievalProcessor.estimate_tokens(answer))
+            session.context_tokens += RetrievalProcessor.estimate_tokens(answer)
+            with MetricsProcessor.use_trace(trace):
+                _finish_turn(session, qstr, answer)
+            finished = True
+        except LawDataProcessor.LawNotIngested as e:
+            yield str(e)
+        finally:
+            if not finished and messages is not None and session.chat is not None:
+                session.chat.history = messages
+                session.context_tokens = context_tokens
+
+
+def quota_key(session_id: str, client: str = None) -> str:
+    """
+    提問配額的鍵：以帳號系統登入時為帳號，否則為用戶端位址(重新整理頁面不會重置配額)
+    Gradio auth的使用者名稱可能是所有人共用的，不使用
+    """
+    account = session_manager.get(session_id).account
+    if account is not None:
+        return "account:" + account
+    if client:
+        return "client:" + client
+    return "session:" + session_id
+
+
+def admitted_chat_stream(qstr, session_id: str = DEFAULT_SESSION, client: str = None):
+    """
+    經過admission排隊後的gemini_chat_stream，配額依quota_key計算
+    排隊期間產生前面的人數及預估等待時間，未被受理時產生原因後結束
+    :param client: 用戶端位址，未以帳號登入時作為配額的鍵
+    :return: generator，每次產生要顯示的完整文字
+    """
     try:
-        chat.send_message(qstr,
-                          generation_config=genai.types.GenerationConfig(
-                              temperature=0.8))
-    except InternalServerError as ise:
-        print(ise.message)
-        time.sleep(3)
-        return gemini_chat(qstr)
-    history = []
-    indx = 0
-    tmp = ["", ""]
-    for message in chat.history:
-        # print(message.role, message.parts[0].text)
-        if indx % 2 == 0:
-            tmp[0] = message.parts[0].text
-        else:
-            tmp[1] = message.parts[0].text
-            history.append((tmp[0], tmp[1]))
-        indx += 1
-    global cur_related_articles
-    if cur_related_articles is None:
-        clean_chatbot()
-    return history[1:]
+        ticket = admission.enqueue(quota_key(session_id, client))
+    except AdmissionProcessor.AdmissionRejected as e:
+        yield str(e)
+        return
+    with ticket:
+        try:
+            while not ticket.wait(1.0):
+                yield "排隊中，前面還有 {} 位，預估等待 {} 秒".format(ticket.position(),
+                                                                  math.ceil(ticket.estimated_wait()))
+        except AdmissionProcessor.AdmissionRejected as e:
+            yield str(e)
+            return
+        yield from gemini_chat_stream(qstr, session_id)
+
+
+def _session_chat(qstr, session: ChatSession):
+    if not session.started:
+        start_chat(qstr, session)
+    response = send_message(session, qstr, 0.8)
+    session.context_tokens += RetrievalProcessor.estimate_tokens(response.text)
+    return _finish_turn(session, qstr, response.text)
+
+
+def _finish_turn(session: ChatSession, question: str, answer: str):
+    """記錄新的一回合並把送給模型的對話限制在視窗內，回傳這一回合的(問題, 回答)"""
+    with MetricsProcessor.span("history_update") as span:
+        turn = (question, answer)
+        session.history.append(turn)
+        if session.account is not None:  # 未以帳號登入(例如共用的Gradio auth)時不保存，避免不同人的紀錄混在一起
+            history_store.append(session.account, session.log_session, question, answer)
+        _trim_window(session)
+        span.set(turns=len(session.history), context_tokens=session.context_tokens)
+        if session.related_articles is None:
+            session.reset()
+        return turn
+
+
+def _trim_window(session: ChatSession):
+    """
+    只保留系統資訊(含條文)那一回合及最近chat_window_turns回合，較舊的回合不再重送給模型
+    每回合的延遲及重送的token數不會隨對話變長而增加
+    """
+    messages = session.chat.history
+    keep = 2 + 2 * chat_window_turns
+    if len(messages) <= keep:
+        return
+    dropped = messages[2:len(messages) - 2 * chat_window_turns]
+    session.chat.history = list(messages[:2]) + list(messages[len(messages) - 2 * chat_window_turns:])
+    session.context_tokens -= sum(RetrievalProcessor.estimate_tokens(m.parts[0].text) for m in dropped)
+
+
+def prewarm(law_names: list[str] = None):
+    """
+    預先載入並建立索引：模型客戶端、嵌入快取、PREWARM_LAWS中的法律(章節/條號、嵌入、BM25索引)及ANN索引
+    由伺服器開始服務後在背景執行，完成前的請求仍可正常處理(只是較慢)
+    各步驟及各法律分別處理錯誤，一部法律失敗不影響其他法律；有錯誤或PREWARM_LAWS中的法律不存在時狀態為failed
+    """
+    if law_names is None:
+        law_names = [n.strip() for n in os.getenv("PREWARM_LAWS", DEFAULT_PREWARM_LAWS).split(",") if n.strip()]
+    start = time.monotonic()
+    _readiness["state"] = "warming"
+
+    def run(name, func):
+        try:
+            func()
+            return True
+        except Exception as e:
+            _readiness["errors"].append("{}: {}".format(name, e))
+            print("[prewarm]: {} {}".format(name, e))
+            return False
+
+    def warm_law(name):
+        law = get_law(name)
+        if law is None:
+            _readiness["laws"][name] = "missing"
+            return
+        law.get_table_of_articles()
+        RetrievalProcessor.get_law_index(law, embedding_quantization)
+        LexicalIndexProcessor.get_lexical_index(law)
+        _readiness["laws"][name] = "ready"
+
+    run("provider", get_provider)
+    run("embedding_cache", get_embedding_cache)
+    run("pandas", lambda: importlib.import_module("pandas"))  # 第一次查詢時不必等pandas匯入
+    for law_name in law_names:
+        if not run(law_name, lambda: warm_law(law_name)):
+            _readiness["laws"][law_name] = "error"
+    run("ann_index", get_ann_index)
+    _readiness["seconds"] = round(time.monotonic() - start, 3)
+    failed = len(_readiness["errors"]) != 0 or any(v != "ready" for v in _readiness["laws"].values())
+    _readiness["state"] = "failed" if failed else "ready"
+    print("[prewarm]: {} {} 秒 {}".format(_readiness["state"], _readiness["seconds"], _readiness["laws"]))
+
+
+def start_prewarm() -> threading.Thread:
+    """在背景執行緒執行prewarm，只會啟動一次"""
+    global _prewarm_thread
+    with _init_lock:
+        if _prewarm_thread is None:
+            _prewarm_thread = threading.Thread(target=prewarm, name="prewarm", daemon=True)
+            _prewarm_thread.start()
+    return _prewarm_thread
+
+
+def readiness() -> dict:
+    """prewarm的狀態：cold/warming/ready/failed，各法律的載入結果及耗時；只有ready時可以接受流量"""
+    return {"ready": _readiness["state"] == "ready",
+            "state": _readiness["state"],
+            "seconds": _readiness["seconds"],
+            "laws": dict(_readiness["laws"]),
+            "errors": list(_readiness["errors"])}
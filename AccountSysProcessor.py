@@ -1,33 +1,193 @@
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
 import joblib
 from google.ai.generativelanguage_v1 import Content as ChatContent
-import os
+
+ACCOUNT_DB_PATH = os.getenv("ACCOUNT_DB_PATH", "users.sqlite3")
+USERS_JSON_PATH = "users.json"
+USERS_DIR = "./Users"
+PASSWORD_HASH_ITERATIONS = 100000
 
 
 class User:
+    """舊版以joblib儲存的帳號(./Users/{id}.account)，只用於遷移到AccountStore"""
+
     def __init__(self, _id: str = "", pswd: str = ""):
-        _userid = _id
-        _paswd = pswd
-        _admit = False
-        _chatHistory: list[list[ChatContent]] | None = None
+        self._userid = _id
+        self._paswd = pswd
+        self._admit = False
+        self._chatHistory: list[list[ChatContent]] | None = None
 
     def get_pswd(self):
         return self._paswd
 
     @staticmethod
     def load_user(_id: str, pswd: str):
-        if not os.path.exists(f"./Users/{_id}.account"):
+        if not os.path.exists(f"{USERS_DIR}/{_id}.account"):
             return False, f"使用者{_id}不存在"
         else:
-            tmpUser: User = joblib.load(f"./Users/{_id}.account")
+            tmpUser: User = joblib.load(f"{USERS_DIR}/{_id}.account")
             if tmpUser.get_pswd() == pswd:
                 return True, tmpUser
             else:
-                return False, f"密碼不正確"
+                return False, "密碼不正確"
 
     @staticmethod
     def dump_user(user):
-        joblib.dump(user,f"./Users/{user._userid}.account")
+        joblib.dump(user, f"{USERS_DIR}/{user._userid}.account")
+
+
+def hash_password(password: str, salt: str = None) -> str:
+    """以PBKDF2-SHA256雜湊密碼，回傳 'pbkdf2_sha256$次數$salt$雜湊值'"""
+    if salt is None:
+        salt = secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("utf-8"), PASSWORD_HASH_ITERATIONS)
+    return "pbkdf2_sha256${}${}${}".format(PASSWORD_HASH_ITERATIONS, salt, digest.hex())
+
+
+def verify_password(password: str, stored: str) -> bool:
+    try:
+        algorithm, iterations, salt, expected = stored.split("$")
+    except ValueError:
+        return False
+    if algorithm != "pbkdf2_sha256":
+        return False
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("utf-8"), int(iterations))
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+class AccountStore:
+    """
+    以SQLite(WAL模式)儲存帳號，username有唯一索引，登入為一次B-tree查詢
+    註冊為單一INSERT，同名帳號同時註冊時只有一個會成功
+    每個執行緒(worker)共用一個連線，fork後的行程會重新開啟連線
+    """
+
+    def __init__(self, path: str = ACCOUNT_DB_PATH, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS users (
+                                id INTEGER PRIMARY KEY,
+                                username TEXT NOT NULL UNIQUE,
+                                password_hash TEXT NOT NULL,
+                                created_at REAL NOT NULL)""")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout={}".format(int(self.timeout * 1000)))
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def register(self, username: str, password: str) -> bool:
+        """
+        註冊帳號
+        :return: 是否註冊成功，名稱或密碼為空、帳戶已存在時回傳False
+        """
+        if username == "" or password == "":
+            return False
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                             (username, hash_password(password), time.time()))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def login(self, username: str, password: str) -> bool:
+        """
+        登入帳號
+        :return: 是否登入成功
+        """
+        row = self._connect().execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
+        return row is not None and verify_password(password, row[0])
+
+    def exists(self, username: str) -> bool:
+        return self._connect().execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def import_accounts(self, accounts: dict[str, str]) -> int:
+        """
+        在同一個交易中匯入明文密碼的帳號，已存在的帳號不覆蓋
+        :return: 新增的帳號數
+        """
+        rows = [(u, hash_password(p), time.time()) for u, p in accounts.items() if u != "" and p != ""]
+        conn = self._connect()
+        with conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                             rows)
+            return conn.total_changes - before
+
+    def migrate_users_json(self, path: str = USERS_JSON_PATH) -> int:
+        """由users.json({使用者名稱: 密碼})遷移"""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r") as f:
+            return self.import_accounts(json.load(f))
+
+    def migrate_account_files(self, users_dir: str = USERS_DIR) -> int:
+        """由./Users/*.account遷移，檔名即使用者名稱"""
+        if not os.path.isdir(users_dir):
+            return 0
+        accounts = {}
+        for file_name in os.listdir(users_dir):
+            if not file_name.endswith(".account"):
+                continue
+            try:
+                user = joblib.load(os.path.join(users_dir, file_name))
+            except Exception as e:
+                print("無法讀取帳號檔 {}: {}".format(file_name, e))
+                continue
+            username = getattr(user, "_userid", "") or file_name[:-len(".account")]
+            accounts[username] = getattr(user, "_paswd", "")
+        return self.import_accounts(accounts)
+
+    def migrate(self) -> int:
+        return self.migrate_users_json() + self.migrate_account_files()
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_account_store() -> AccountStore:
+    """取得共用的AccountStore，第一次建立資料庫時自動由users.json及.account檔遷移"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = AccountStore()
+                if len(store) == 0:
+                    migrated = store.migrate()
+                    if migrated != 0:
+                        print("已遷移 {} 個帳號到 {}".format(migrated, store.path))
+                _store = store
+    return _store
 
-    @staticmethod
-    def signup
 
+if __name__ == '__main__':
+    print("已遷移 {} 個帳號".format(get_account_store().migrate()))
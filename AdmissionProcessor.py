@@ -0,0 +1,177 @@
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+from LLMClientProcessor import TokenBucket
+
+
+class AdmissionRejected(Exception):
+    """請求未被受理(佇列已滿、超過個人配額或等候逾時)，訊息可直接顯示給使用者"""
+
+
+class Ticket:
+    """
+    排隊中的一個請求，以with使用：離開時釋放執行名額，尚未輪到時則取消排隊
+    串流的generator被關閉(使用者離開頁面)時也會離開with，不會佔住名額
+    """
+
+    def __init__(self, controller: "AdmissionController", user: str):
+        self.controller = controller
+        self.user = user
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+        self.released = False
+
+    def wait(self, timeout: float = None) -> bool:
+        """等待輪到執行，timeout秒內未輪到回傳False；超過佇列的等候上限時拋出AdmissionRejected"""
+        return self.controller._wait(self, timeout)
+
+    def position(self) -> int:
+        """前面還有幾個請求在排隊，已開始執行時為0"""
+        return self.controller._position(self)
+
+    def estimated_wait(self) -> float:
+        """預估還要等待的秒數"""
+        return self.controller._estimate(self.position())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    對話請求的受理控制
+    同時執行的請求最多max_concurrency個，其餘依先後排隊，佇列超過max_queue時直接拒絕(load shedding)
+    每個使用者另有令牌桶配額，避免少數使用者佔滿模型的速率限制
+    :param queue_timeout: 排隊超過的秒數後放棄，讓尾端延遲有上限
+    :param user_requests_per_minute: 每個使用者每分鐘可提問的次數
+    :param user_burst: 每個使用者可連續提問的次數，預設等於每分鐘次數
+    :param max_users: 保留配額狀態的使用者數，超過時淘汰最久未使用的(被淘汰的使用者配額重新計算)
+    :param initial_service_seconds: 尚無資料時每個請求的預估執行秒數
+    """
+
+    def __init__(self, max_concurrency: int = 4, max_queue: int = 16, queue_timeout: float = 60,
+                 user_requests_per_minute: float = 10, user_burst: float = None, max_users: int = 10000,
+                 initial_service_seconds: float = 10):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.user_requests_per_minute = user_requests_per_minute
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.service_seconds = initial_service_seconds  # 執行時間的指數移動平均
+        self._cond = threading.Condition()
+        self._waiting: deque[Ticket] = deque()
+        self._active = 0
+        self._user_buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self.admitted = 0
+        self.shed = 0
+        self.throttled = 0
+        self.timed_out = 0
+
+    def _user_bucket_locked(self, user: str) -> TokenBucket:
+        bucket = self._user_buckets.get(user)
+        if bucket is None:
+            bucket = self._user_buckets[user] = TokenBucket(self.user_requests_per_minute, self.user_burst)
+            while len(self._user_buckets) > self.max_users:
+                self._user_buckets.popitem(last=False)
+        else:
+            self._user_buckets.move_to_end(user)
+        return bucket
+
+    def _estimate(self, position: int) -> float:
+        """排在第position位(0為下一個)的請求預估等待秒數"""
+        return (position // self.max_concurrency + 1) * self.service_seconds
+
+    def enqueue(self, user: str) -> Ticket:
+        """
+        排入佇列，佇列已滿或使用者超過配額時拋出AdmissionRejected
+        被拒絕的請求不扣使用者的配額
+        """
+        with self._cond:
+            if len(self._waiting) >= self.max_queue and self._active >= self.max_concurrency:
+                self.shed += 1
+                raise AdmissionRejected("目前使用人數眾多，請約 {} 秒後再試".format(
+                    math.ceil(self._estimate(len(self._waiting)))))
+            if self.user_requests_per_minute > 0:
+                wait = self._user_bucket_locked(user).try_acquire(1)
+                if wait > 0:
+                    self.throttled += 1
+                    raise AdmissionRejected("提問次數已達上限，請於 {} 秒後再試".format(math.ceil(wait)))
+            ticket = Ticket(self, user)
+            self._waiting.append(ticket)
+            self._dispatch_locked()
+            return ticket
+
+    def _dispatch_locked(self):
+        admitted = False
+        while len(self._waiting) != 0 and self._active < self.max_concurrency:
+            ticket = self._waiting.popleft()
+            ticket.admitted_at = time.monotonic()
+            self._active += 1
+            self.admitted += 1
+            admitted = True
+        if admitted:
+            self._cond.notify_all()
+
+    def _wait(self, ticket: Ticket, timeout: float = None) -> bool:
+        with self._cond:
+            end = None if timeout is None else time.monotonic() + timeout
+            while ticket.admitted_at is None:
+                now = time.monotonic()
+                if self.queue_timeout is not None and now - ticket.enqueued_at >= self.queue_timeout:
+                    self._cancel_locked(ticket)
+                    self.timed_out += 1
+                    raise AdmissionRejected("等候逾時，目前使用人數眾多，請稍後再試")
+                remaining = []
+                if end is not None:
+                    if now >= end:
+                        return False
+                    remaining.append(end - now)
+                if self.queue_timeout is not None:
+                    remaining.append(ticket.enqueued_at + self.queue_timeout - now)
+                self._cond.wait(min(remaining) if len(remaining) != 0 else None)
+            return True
+
+    def _position(self, ticket: Ticket) -> int:
+        with self._cond:
+            if ticket.admitted_at is not None:
+                return 0
+            for i, t in enumerate(self._waiting):
+                if t is ticket:
+                    return i
+            return 0
+
+    def _cancel_locked(self, ticket: Ticket):
+        ticket.released = True
+        try:
+            self._waiting.remove(ticket)
+        except ValueError:
+            pass
+
+    def _release(self, ticket: Ticket):
+        with self._cond:
+            if ticket.released:
+                return
+            if ticket.admitted_at is None:
+                self._cancel_locked(ticket)
+                return
+            ticket.released = True
+            self._active -= 1
+            elapsed = time.monotonic() - ticket.admitted_at
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * elapsed
+            self._dispatch_locked()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"active": self._active,
+                    "waiting": len(self._waiting),
+                    "admitted": self.admitted,
+                    "shed": self.shed,
+                    "throttled": self.throttled,
+                    "timed_out": self.timed_out,
+                    "service_seconds": self.service_seconds}
@@ -0,0 +1,284 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+import LawDataProcessor
+from LawDataProcessor import DATA_DIR, LawData
+from RetrievalProcessor import normalize_rows, select_top_k
+
+ANN_INDEX_PATH = os.path.join(DATA_DIR, "ann_index.npz")
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0,
+           batch_size: int = 16384) -> np.ndarray:
+    """
+    球面k-means(向量已L2正規化，以點積分群)，回傳正規化的群中心
+    空的群以隨機樣本重新初始化
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = assign_clusters(vectors, centroids, batch_size)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=n_clusters)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty) != 0:
+            sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def assign_clusters(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 16384) -> np.ndarray:
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for i in range(0, len(vectors), batch_size):
+        assign[i:i + batch_size] = np.argmax(vectors[i:i + batch_size] @ centroids.T, axis=1)
+    return assign
+
+
+class IVFIndex:
+    """
+    跨法律的IVF(倒排檔)近似最近鄰索引
+    向量依最近的群中心分到n_lists個清單，查詢時只計算與查詢最接近的nprobe個清單
+    nprobe越大召回率越高、延遲越高，nprobe等於n_lists時等同精確搜尋
+    條文以(法律名稱, 條號)識別；重新嵌入的法律以replace_law更新，舊的向量標記刪除
+    """
+
+    def __init__(self, centroids: np.ndarray, nprobe: int = 8):
+        self.centroids = normalize_rows(centroids)
+        self.nprobe = nprobe
+        self.law_names: list[str] = []
+        self.article_numbers: list[str] = []
+        self.alive = np.zeros(0, dtype=bool)
+        self._law_rows: dict[str, list[int]] = {}
+        self._list_vectors: list[list[np.ndarray]] = [[] for _ in range(len(self.centroids))]
+        self._list_ids: list[list[np.ndarray]] = [[] for _ in range(len(self.centroids))]
+        self._lock = threading.RLock()
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, n_lists: int = None, nprobe: int = 8, sample_size: int = 100000,
+              iterations: int = 10, seed: int = 0) -> "IVFIndex":
+        """由樣本向量訓練群中心，n_lists預設約為4*sqrt(向量數)"""
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        rng = np.random.default_rng(seed)
+        sample = vectors if len(vectors) <= sample_size else vectors[np.sort(rng.choice(len(vectors), sample_size,
+                                                                                         replace=False))]
+        return cls(kmeans(normalize_rows(sample), n_lists, iterations, seed), nprobe)
+
+    def _list(self, i: int) -> tuple[np.ndarray, np.ndarray]:
+        """取得第i個清單的向量及編號，多段時合併成一段"""
+        if len(self._list_vectors[i]) > 1:
+            self._list_vectors[i] = [np.concatenate(self._list_vectors[i])]
+            self._list_ids[i] = [np.concatenate(self._list_ids[i])]
+        if len(self._list_vectors[i]) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        return self._list_vectors[i][0], self._list_ids[i][0]
+
+    def add(self, law_name: str, article_numbers: list[str], vectors: np.ndarray):
+        """加入一部法律的條文向量"""
+        vectors = normalize_rows(vectors)
+        with self._lock:
+            start = len(self.law_names)
+            ids = np.arange(start, start + len(vectors), dtype=np.int64)
+            self.law_names.extend([law_name] * len(vectors))
+            self.article_numbers.extend(article_numbers)
+            self.alive = np.concatenate([self.alive, np.ones(len(vectors), dtype=bool)])
+            self._law_rows.setdefault(law_name, []).extend(ids.tolist())
+            assign = assign_clusters(vectors, self.centroids)
+            order = np.argsort(assign, kind="stable")
+            bounds = np.searchsorted(assign[order], np.arange(self.n_lists + 1))
+            for i in np.flatnonzero(np.diff(bounds)):
+                rows = order[bounds[i]:bounds[i + 1]]
+                self._list_vectors[i].append(vectors[rows])
+                self._list_ids[i].append(ids[rows])
+
+    def remove_law(self, law_name: str) -> int:
+        """標記刪除一部法律的所有向量，回傳刪除數"""
+        with self._lock:
+            rows = self._law_rows.pop(law_name, [])
+            self.alive[rows] = False
+            return len(rows)
+
+    def replace_law(self, law: LawData):
+        """法律重新嵌入後更新：刪除舊的向量並加入新的"""
+        numbers, vectors = law_vectors(law)
+        with self._lock:
+            self.remove_law(law.law_name)
+            if len(numbers) != 0:
+                self.add(law.law_name, numbers, vectors)
+
+    def compact(self):
+        """移除標記刪除的向量，刪除較多時可定期執行"""
+        with self._lock:
+            if self.alive.all():
+                return
+            remap = np.cumsum(self.alive) - 1
+            for i in range(self.n_lists):
+                vectors, ids = self._list(i)
+                keep = self.alive[ids]
+                self._list_vectors[i] = [vectors[keep]] if keep.any() else []
+                self._list_ids[i] = [remap[ids[keep]]] if keep.any() else []
+            kept = np.flatnonzero(self.alive)
+            self.law_names = [self.law_names[i] for i in kept]
+            self.article_numbers = [self.article_numbers[i] for i in kept]
+            self.alive = np.ones(len(kept), dtype=bool)
+            self._law_rows = {}
+            for row, name in enumerate(self.law_names):
+                self._law_rows.setdefault(name, []).append(row)
+
+    def _results(self, ids: np.ndarray, scores: np.ndarray, top_k: int) -> list[tuple[str, str, float]]:
+        idx = select_top_k(scores, top_k)
+        return [(self.law_names[ids[i]], self.article_numbers[ids[i]], float(scores[i])) for i in idx]
+
+    def search(self, query_embedding, top_k: int = 10, nprobe: int = None) -> list[tuple[str, str, float]]:
+        """
+        :param nprobe: 搜尋的清單數，預設為self.nprobe
+        :return: [(法律名稱, 條號, 點積值), ...]，依相關度排序
+        """
+        query = normalize_rows(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1))[0]
+        nprobe = min(self.nprobe if nprobe is None else nprobe, self.n_lists)
+        with self._lock:
+            probes = select_top_k(self.centroids @ query, nprobe)
+            all_ids = []
+            all_scores = []
+            for i in probes:
+                vectors, ids = self._list(i)
+                if len(ids) == 0:
+                    continue
+                keep = self.alive[ids]
+                all_ids.append(ids[keep])
+                all_scores.append(vectors[keep] @ query)
+            if len(all_ids) == 0:
+                return []
+            return self._results(np.concatenate(all_ids), np.concatenate(all_scores), top_k)
+
+    def exact_search(self, query_embedding, top_k: int = 10) -> list[tuple[str, str, float]]:
+        """搜尋所有清單(精確結果)，用於量測召回率"""
+        return self.search(query_embedding, top_k, nprobe=self.n_lists)
+
+    def measure_recall(self, queries: np.ndarray, top_k: int = 10, nprobes: list[int] = None) -> list[dict]:
+        """
+        量測不同nprobe的召回率(與精確搜尋的前top_k條重疊的比例)及平均延遲
+        """
+        nprobes = nprobes or [1, 2, 4, 8, 16, 32, 64]
+        exact = [{(r[0], r[1]) for r in self.exact_search(q, top_k)} for q in queries]
+        report = []
+        for nprobe in nprobes:
+            hits = 0
+            start = time.perf_counter()
+            results = [self.search(q, top_k, nprobe) for q in queries]
+            elapsed = time.perf_counter() - start
+            for truth, result in zip(exact, results):
+                hits += len(truth & {(r[0], r[1]) for r in result})
+            report.append({"nprobe": nprobe,
+                           "recall": hits / max(1, sum(len(t) for t in exact)),
+                           "latency_ms": elapsed / max(1, len(queries)) * 1000})
+        return report
+
+    def save(self, path: str = ANN_INDEX_PATH):
+        with self._lock:
+            self.compact()
+            vectors = []
+            ids = []
+            offsets = [0]
+            for i in range(self.n_lists):
+                v, d = self._list(i)
+                vectors.append(v)
+                ids.append(d)
+                offsets.append(offsets[-1] + len(d))
+            tmp_path = path + ".tmp.npz"
+            np.savez(tmp_path, centroids=self.centroids, nprobe=np.asarray(self.nprobe),
+                     vectors=np.concatenate(vectors) if len(vectors) != 0 else np.zeros((0, self.dim), np.float32),
+                     ids=np.concatenate(ids) if len(ids) != 0 else np.zeros(0, np.int64),
+                     offsets=np.asarray(offsets, dtype=np.int64),
+                     law_names=np.asarray(self.law_names, dtype=str),
+                     article_numbers=np.asarray(self.article_numbers, dtype=str))
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = ANN_INDEX_PATH) -> "IVFIndex":
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(data["centroids"], int(data["nprobe"]))
+            vectors, ids, offsets = data["vectors"], data["ids"], data["offsets"]
+            for i in range(index.n_lists):
+                if offsets[i + 1] > offsets[i]:
+                    index._list_vectors[i] = [vectors[offsets[i]:offsets[i + 1]]]
+                    index._list_ids[i] = [ids[offsets[i]:offsets[i + 1]]]
+            index.law_names = data["law_names"].tolist()
+            index.article_numbers = data["article_numbers"].tolist()
+        index.alive = np.ones(len(index.law_names), dtype=bool)
+        for row, name in enumerate(index.law_names):
+            index._law_rows.setdefault(name, []).append(row)
+        return index
+
+
+def law_vectors(law: LawData) -> tuple[list[str], np.ndarray]:
+    """回傳有條號且有嵌入向量的條文 (條號, 向量矩陣)，編章節標題不列入"""
+    matrix = law.embedding_matrix
+    rows = [i for i, a in enumerate(law.law_articles) if a.article_number != ""]
+    if matrix is None or len(rows) == 0:
+        return [], np.zeros((0, 0), dtype=np.float32)
+    return [law.law_articles[i].article_number for i in rows], np.asarray(matrix[rows], dtype=np.float32)
+
+
+def iter_stored_laws(data_dir: str = DATA_DIR):
+    """依序載入data_dir中以二進位格式儲存的法律(嵌入矩陣為mmap)"""
+    for file_name in sorted(os.listdir(data_dir)):
+        if file_name.endswith(".meta.json"):
+            meta_path, npy_path, _ = LawDataProcessor.get_data_paths(file_name[:-len(".meta.json")], data_dir)
+            if not os.path.exists(npy_path):
+                continue
+            law = LawData()
+            law.get_law_binary_data(meta_path, npy_path)
+            yield law
+
+
+def build_ann_index(data_dir: str = DATA_DIR, n_lists: int = None, nprobe: int = 8, path: str = None,
+                    sample_per_law: int = 2000) -> IVFIndex:
+    """
+    由data_dir中已儲存的嵌入向量建立索引並存檔(path預設為 {data_dir}/ann_index.npz)
+    訓練樣本由每部法律最多取sample_per_law條，不需一次載入整個語料
+    """
+    rng = np.random.default_rng(0)
+    samples = []
+    for law in iter_stored_laws(data_dir):
+        _, vectors = law_vectors(law)
+        if len(vectors) > sample_per_law:
+            vectors = vectors[np.sort(rng.choice(len(vectors), sample_per_law, replace=False))]
+        if len(vectors) != 0:
+            samples.append(vectors)
+    if len(samples) == 0:
+        raise ValueError("{} 中沒有已嵌入的法律".format(data_dir))
+    samples = np.concatenate(samples)
+    total = 0
+    for law in iter_stored_laws(data_dir):
+        total += sum(1 for a in law.law_articles if a.article_number != "")
+    if n_lists is None:
+        n_lists = int(4 * np.sqrt(total))
+    index = IVFIndex.train(samples, min(n_lists, len(samples)), nprobe)
+    for law in iter_stored_laws(data_dir):
+        numbers, vectors = law_vectors(law)
+        if len(numbers) != 0:
+            index.add(law.law_name, numbers, vectors)
+    index.save(path or os.path.join(data_dir, "ann_index.npz"))
+    return index
+
+
+if __name__ == '__main__':
+    ann = build_ann_index()
+    print("{} 條，{} 個清單".format(len(ann), ann.n_lists))
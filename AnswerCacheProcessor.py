@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Union
+
+import numpy as np
+
+
+class CachedAnswer:
+    """快取的回答及其相關條文"""
+
+    def __init__(self, question: str, answer: str, articles: list, law_versions: dict[str, str], route=None):
+        self.question = question
+        self.answer = answer
+        self.articles = articles
+        self.law_versions = law_versions  # 法律名稱 -> LawModifiedDate，任一法律異動後此回答失效
+        self.route = route  # 問題指定的條號及分類結果，相同才可沿用
+        self.created = time.monotonic()
+        self.hits = 0
+
+
+class SemanticAnswerCache:
+    """
+    相似問題的回答快取
+    以過去問題的正規化嵌入向量組成小型向量索引，新問題與某個過去問題的相似度達到threshold、
+    且route(指定的條號及分類結果)相同時直接回傳該回答；只差在條號的問題嵌入向量幾乎相同，不能只看相似度
+    :param threshold: 餘弦相似度門檻
+    :param ttl: 回答保存秒數
+    :param max_entries: 最多保存幾筆，超過時淘汰最久未使用的
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 24 * 3600, max_entries: int = 1024):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._matrix: Union[np.ndarray, None] = None  # 每個slot一列，空的slot為零向量
+        self._entries: OrderedDict[int, CachedAnswer] = OrderedDict()  # slot -> 回答，依最近使用排序
+        self._free_slots: list[int] = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm != 0 else vector
+
+    def _remove_locked(self, slot: int):
+        del self._entries[slot]
+        self._matrix[slot] = 0
+        self._free_slots.append(slot)
+
+    def lookup(self, query_embedding, law_versions_func: Callable[[list[str]], dict[str, str]] = None,
+               route=None) -> Union[CachedAnswer, None]:
+        """
+        :param query_embedding: 問題的嵌入向量
+        :param law_versions_func: 輸入法律名稱清單，回傳目前的 法律名稱 -> LawModifiedDate，用來判斷回答是否過期
+        :param route: 問題的路由結果，只有put時的route相同的回答才算命中
+        """
+        query = self._normalize(query_embedding)
+        with self._lock:
+            if self._matrix is None or len(self._entries) == 0 or self._matrix.shape[1] != len(query):
+                self.misses += 1
+                return None
+            scores = self._matrix @ query
+            now = time.monotonic()
+            while True:
+                slot = int(np.argmax(scores))
+                if scores[slot] < self.threshold or slot not in self._entries:
+                    self.misses += 1
+                    return None
+                entry = self._entries[slot]
+                if now - entry.created > self.ttl:
+                    self._remove_locked(slot)
+                elif entry.route == route:
+                    break
+                scores[slot] = -1.0
+        # 查詢法律版本可能需要載入法律，不持有鎖
+        if law_versions_func is not None and law_versions_func(list(entry.law_versions)) != entry.law_versions:
+            with self._lock:
+                if self._entries.get(slot) is entry:
+                    self._remove_locked(slot)
+                    self.invalidations += 1
+                self.misses += 1
+            return None
+        with self._lock:
+            if self._entries.get(slot) is entry:
+                self._entries.move_to_end(slot)
+            entry.hits += 1
+            self.hits += 1
+        return entry
+
+    def put(self, question: str, query_embedding, answer: str, articles: list, law_versions: dict[str, str],
+            route=None):
+        query = self._normalize(query_embedding)
+        entry = CachedAnswer(question, answer, articles, law_versions, route)
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != len(query):
+                self._matrix = np.zeros((self.max_entries, len(query)), dtype=np.float32)
+                self._entries.clear()
+                self._free_slots = list(range(self.max_entries - 1, -1, -1))
+            if len(self._free_slots) == 0:
+                oldest = next(iter(self._entries))
+                self._remove_locked(oldest)
+                self.evictions += 1
+            slot = self._free_slots.pop()
+            self._matrix[slot] = query
+            self._entries[slot] = entry
+
+    def invalidate_law(self, law_name: str) -> int:
+        """清除所有引用到指定法律的回答"""
+        with self._lock:
+            slots = [slot for slot, entry in self._entries.items() if law_name in entry.law_versions]
+            for slot in slots:
+                self._remove_locked(slot)
+            self.invalidations += len(slots)
+            return len(slots)
+
+    def clear(self):
+        with self._lock:
+            for slot in list(self._entries):
+                self._remove_locked(slot)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "hit_rate": self.hits / total if total != 0 else 0.0}
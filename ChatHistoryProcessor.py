@@ -0,0 +1,158 @@
+import gzip
+import json
+import os
+import threading
+import time
+from urllib.parse import quote, unquote
+
+CHAT_HISTORY_DIR = "ChatHistory"
+LOG_SUFFIX = ".jsonl"
+ARCHIVE_SUFFIX = ".archive.jsonl.gz"
+
+
+def split_session_id(session_id: str) -> tuple[str, str]:
+    """ChatSessionManager的session鍵('使用者:session_hash')拆成(使用者, session)"""
+    user, sep, session = session_id.partition(":")
+    return user, session if sep else "default"
+
+
+def _tail_lines(path: str, n: int, block_size: int = 8192) -> list[bytes]:
+    """由檔尾往前讀取最後n行，不讀整個檔案"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + data
+    lines = data.splitlines()
+    if pos > 0:  # 第一行可能只讀到一半
+        lines = lines[1:]
+    return lines[-n:] if n > 0 else []
+
+
+def _parse_turns(lines: list[bytes]) -> list[tuple[str, str]]:
+    turns = []
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:  # 寫入中斷留下的不完整行
+            continue
+        turns.append((record["question"], record["answer"]))
+    return turns
+
+
+class ChatHistoryStore:
+    """
+    對話紀錄，每個使用者的每個session一個只能附加的JSONL檔：{root}/{使用者}/{session}.jsonl
+    每回合寫入一行(O(1))，載入時只由檔尾讀取最近的N回合
+    檔案超過compact_bytes時進行壓縮：較舊的回合移到gzip封存檔，只保留最近keep_turns回合
+    """
+
+    def __init__(self, root: str = CHAT_HISTORY_DIR, compact_bytes: int = 1024 * 1024, keep_turns: int = 200):
+        self.root = root
+        self.compact_bytes = compact_bytes
+        self.keep_turns = keep_turns
+        self._locks: dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def _user_dir(self, user: str) -> str:
+        return os.path.join(self.root, quote(user, safe="") or "_")
+
+    def get_path(self, user: str, session: str) -> str:
+        return os.path.join(self._user_dir(user), quote(session, safe="") + LOG_SUFFIX)
+
+    def _lock(self, path: str) -> threading.Lock:
+        with self._locks_lock:
+            lock = self._locks.get(path)
+            if lock is None:
+                lock = self._locks[path] = threading.Lock()
+            return lock
+
+    def append(self, user: str, session: str, question: str, answer: str):
+        """寫入一回合"""
+        path = self.get_path(user, session)
+        line = json.dumps({"time": time.time(), "question": question, "answer": answer},
+                          ensure_ascii=False) + "\n"
+        with self._lock(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'a', encoding="utf-8") as f:
+                f.write(line)
+                size = f.tell()
+        if size > self.compact_bytes:
+            self.compact(user, session)
+
+    def load_recent(self, user: str, session: str, n: int) -> list[tuple[str, str]]:
+        """
+        載入最近的n回合
+        :return: [(問題, 回答), ...]，由舊到新
+        """
+        path = self.get_path(user, session)
+        if n <= 0 or not os.path.exists(path):
+            return []
+        with self._lock(path):
+            return _parse_turns(_tail_lines(path, n))
+
+    def sessions(self, user: str) -> list[str]:
+        """使用者的所有session，最近寫入的在前"""
+        user_dir = self._user_dir(user)
+        if not os.path.isdir(user_dir):
+            return []
+        entries = [e for e in os.scandir(user_dir) if e.name.endswith(LOG_SUFFIX)]
+        entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+        return [unquote(e.name[:-len(LOG_SUFFIX)]) for e in entries]
+
+    def latest_session(self, user: str):
+        sessions = self.sessions(user)
+        return sessions[0] if len(sessions) != 0 else None
+
+    def compact(self, user: str, session: str, keep_turns: int = None) -> int:
+        """
+        只保留最近keep_turns回合，較舊的附加到gzip封存檔
+        :return: 移到封存檔的回合數
+        """
+        keep_turns = self.keep_turns if keep_turns is None else keep_turns
+        path = self.get_path(user, session)
+        with self._lock(path):
+            if not os.path.exists(path):
+                return 0
+            with open(path, 'rb') as f:
+                lines = [line for line in f.read().splitlines() if line.strip()]
+            if len(lines) <= keep_turns:
+                return 0
+            old, recent = lines[:len(lines) - keep_turns], lines[len(lines) - keep_turns:]
+            with gzip.open(path[:-len(LOG_SUFFIX)] + ARCHIVE_SUFFIX, 'ab') as f:  # gzip可附加多個成員
+                f.write(b"\n".join(old) + b"\n")
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(b"".join(line + b"\n" for line in recent))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            return len(old)
+
+    def compact_all(self) -> int:
+        """壓縮所有超過compact_bytes的紀錄檔，可定期執行"""
+        moved = 0
+        if not os.path.isdir(self.root):
+            return 0
+        for user_entry in os.scandir(self.root):
+            if not user_entry.is_dir():
+                continue
+            for entry in os.scandir(user_entry.path):
+                if entry.name.endswith(LOG_SUFFIX) and entry.stat().st_size > self.compact_bytes:
+                    moved += self.compact(unquote(user_entry.name), unquote(entry.name[:-len(LOG_SUFFIX)]))
+        return moved
+
+    def delete(self, user: str, session: str):
+        path = self.get_path(user, session)
+        with self._lock(path):
+            for p in (path, path[:-len(LOG_SUFFIX)] + ARCHIVE_SUFFIX):
+                if os.path.exists(p):
+                    os.remove(p)
+
+
+if __name__ == '__main__':
+    print("已封存 {} 回合".format(ChatHistoryStore().compact_all()))
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Union
+
+DEFAULT_SESSION = "default"
+
+
+class ChatSession:
+    """單一使用者的對話狀態"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.lock = threading.Lock()  # 同一使用者的對話依序處理
+        self.last_active = time.monotonic()
+        self.chat = None
+        self.started = False
+        self.related_articles = None
+        self.history: list[tuple[str, str]] = []
+        self.context_tokens = 0  # 對話紀錄的估計token數，每次送出訊息都會重送
+        self.log_session = None  # 對話紀錄寫入ChatHistoryStore的session(這個瀏覽器session自己的)
+        self.account = None  # 以帳號系統登入的帳號，對話紀錄及配額以此區分；未登入時為None，reset()不清除
+
+    def reset(self):
+        self.chat = None
+        self.started = False
+        self.related_articles = None
+        self.history = []
+        self.context_tokens = 0
+        self.log_session = None
+
+
+class ChatSessionManager:
+    """
+    以Gradio session或使用者區分的對話管理
+    閒置超過idle_timeout秒的對話會被清除，對話數超過max_sessions時淘汰最久未使用的
+    不同使用者的對話可並行，同一使用者的對話以該session的鎖依序執行
+    """
+
+    def __init__(self, idle_timeout: float = 1800, max_sessions: int = 1000):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def get(self, session_id: str = DEFAULT_SESSION) -> ChatSession:
+        with self._lock:
+            self._evict_locked()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id)
+                self._sessions[session_id] = session
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_active = time.monotonic()
+            return session
+
+    @contextmanager
+    def session(self, session_id: str = DEFAULT_SESSION):
+        """取得session並持有其鎖，離開時更新最後使用時間"""
+        session = self.get(session_id)
+        with session.lock:
+            try:
+                yield session
+            finally:
+                session.last_active = time.monotonic()
+
+    def clear(self, session_id: str = DEFAULT_SESSION):
+        """清除對話內容(例如按下清除或登出)，會等待該session進行中的對話結束"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None:
+            with session.lock:
+                session.reset()
+
+    def set_account(self, session_id: str, account: str = None):
+        """登入(或登出，account為None)時設定session的帳號，帳號改變時清除對話內容"""
+        session = self.get(session_id)
+        with session.lock:
+            if session.account != account:
+                session.reset()
+            session.account = account
+
+    def remove(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def evict_idle(self) -> int:
+        with self._lock:
+            return self._evict_locked()
+
+    def _evict_locked(self) -> int:
+        evicted = 0
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_active > self.idle_timeout and not session.lock.locked():
+                del self._sessions[session_id]
+                evicted += 1
+        # 超過上限時由最久未使用的開始淘汰，進行中的對話不淘汰
+        for session_id, session in list(self._sessions.items()):
+            if len(self._sessions) < self.max_sessions:
+                break
+            if not session.lock.locked():
+                del self._sessions[session_id]
+                evicted += 1
+        self.evictions += evicted
+        return evicted
+
+
+def client_from_request(request) -> Union[str, None]:
+    """由gr.Request取得用戶端位址"""
+    client = getattr(request, "client", None)
+    return getattr(client, "host", None)
+
+
+def session_id_from_request(request) -> str:
+    """
+    由gr.Request取得session鍵：Gradio的使用者名稱加上session_hash
+    Gradio的auth可能是所有人共用的帳號，不能代表使用者，使用者的帳號另外以ChatSessionManager.set_account設定
+    """
+    if request is None:
+        return DEFAULT_SESSION
+    username = getattr(request, "username", None)
+    session_hash = getattr(request, "session_hash", None)
+    if username and session_hash:
+        return "{}:{}".format(username, session_hash)
+    return username or session_hash or DEFAULT_SESSION
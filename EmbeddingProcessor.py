@@ -0,0 +1,333 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from LawDataProcessor import (DATA_DIR, LawData, get_data_paths, get_pending_embeddings_path, load_pending_embeddings,
+                              save_data)
+
+EMBEDDING_MODEL = 'models/embedding-001'
+MAX_BATCH_SIZE = 100  # batchEmbedContents 單次請求的上限
+CHECKPOINT_DIR = os.path.join(DATA_DIR, ".checkpoints")
+EMBEDDING_CACHE_PATH = os.path.join(DATA_DIR, "embedding_cache.sqlite3")
+
+
+def content_hash(content: str, title: str = "", model: str = EMBEDDING_MODEL,
+                 task_type: str = "retrieval_document") -> str:
+    """嵌入向量由模型、任務類型、標題及內容決定，以此作為是否需要重新嵌入的依據"""
+    key = json.dumps([model, task_type, title, content], ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class GeminiEmbedder:
+    """以batchEmbedContents批次嵌入，每條內容可各自帶標題"""
+
+    def __init__(self, model: str = EMBEDDING_MODEL, task_type: str = "retrieval_document", client=None):
+        """:param client: LLMClientProcessor.LLMClient，提供重試、斷路器及速率限制"""
+        self.model = model
+        self.task_type = task_type
+        self.client = client
+
+    def embed_batch(self, contents: list[str], titles: list[str] = None) -> list[list[float]]:
+        import google.ai.generativelanguage as glm
+        from google.generativeai.client import get_default_generative_client
+
+        if titles is None:
+            titles = [None] * len(contents)
+        task_type = glm.TaskType[self.task_type.upper()]
+        requests = []
+        for content, title in zip(contents, titles):
+            request = glm.EmbedContentRequest(model=self.model,
+                                              content=glm.Content(parts=[glm.Part(text=content)]),
+                                              task_type=task_type)
+            if title:
+                request.title = title
+            requests.append(request)
+        batch_request = glm.BatchEmbedContentsRequest(model=self.model, requests=requests)
+        batch_embed = get_default_generative_client().batch_embed_contents
+        if self.client is not None:
+            tokens = sum(len(c) + len(t or "") for c, t in zip(contents, titles))
+            response = self.client.call(batch_embed, batch_request, tokens=tokens)
+        else:
+            response = batch_embed(batch_request)
+        return [list(e.values) for e in response.embeddings]
+
+
+class FakeEmbedder:
+    """
+    本地假嵌入器，由內容雜湊產生固定的單位向量，供測試及離線執行使用
+    :param fail_after: 嵌入超過此條數後拋出例外，用來模擬中途失敗
+    """
+
+    def __init__(self, dim: int = 768, model: str = "fake", task_type: str = "retrieval_document",
+                 fail_after: int = None):
+        self.dim = dim
+        self.model = model
+        self.task_type = task_type
+        self.fail_after = fail_after
+        self.calls = 0
+        self.embedded = 0
+
+    def embed_one(self, content: str, title: str = None) -> list[float]:
+        seed = int(hashlib.sha256((str(title) + "\0" + content).encode("utf-8")).hexdigest()[:16], 16)
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_batch(self, contents: list[str], titles: list[str] = None) -> list[list[float]]:
+        if titles is None:
+            titles = [None] * len(contents)
+        self.calls += 1
+        if self.fail_after is not None and self.embedded + len(contents) > self.fail_after:
+            raise RuntimeError("FakeEmbedder: simulated failure")
+        self.embedded += len(contents)
+        return [self.embed_one(c, t) for c, t in zip(contents, titles)]
+
+
+class EmbeddingCheckpoint:
+    """
+    嵌入進度檢查點，每完成一批就以一行JSON附加寫入並fsync
+    重新執行時讀回已完成的嵌入，寫到一半的最後一行會被略過
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict[str, list[float]]:
+        result = {}
+        if not os.path.exists(self.path):
+            return result
+        with open(self.path, 'r', encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                result[record["hash"]] = record["embedding"]
+        return result
+
+    def append(self, hashes: list[str], embeddings: list[list[float]]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, 'a', encoding="utf-8") as f:
+            for h, e in zip(hashes, embeddings):
+                f.write(json.dumps({"hash": h, "embedding": [float(x) for x in e]}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_stored_embeddings(law_name: str, embedder, data_dir: str = DATA_DIR) -> dict[str, list[float]]:
+    """讀取已儲存的法律資料及條文異動前保留的嵌入向量，回傳 內容雜湊 -> 嵌入向量"""
+    result = {}
+    for number, content, embedding in load_pending_embeddings(law_name, data_dir):
+        h = content_hash(content, law_name + " " + number, embedder.model, embedder.task_type)
+        result[h] = embedding
+    meta_path, npy_path, json_path = get_data_paths(law_name, data_dir)
+    stored = LawData()
+    if os.path.exists(meta_path):
+        stored.get_law_binary_data(meta_path, npy_path)
+    elif os.path.exists(json_path):
+        with open(json_path, 'r', encoding="utf-8") as f:
+            stored.get_law_json_data(f, law_name)
+    else:
+        return result
+    for a in stored.law_articles:
+        if a.article_embedding is not None:
+            h = content_hash(a.article_content, a.get_article_title(law_name), embedder.model, embedder.task_type)
+            result[h] = a.article_embedding
+    return result
+
+
+def ingest_embeddings(law: LawData, embedder=None, batch_size: int = MAX_BATCH_SIZE, max_in_flight: int = 4,
+                      checkpoint_dir: str = CHECKPOINT_DIR, data_dir: str = DATA_DIR, save: bool = True) -> dict:
+    """
+    批次、並行、可續傳地嵌入法律的所有條文
+    :param law: 要嵌入的法律，嵌入結果直接寫回其條文
+    :param embedder: 具有 embed_batch(contents, titles)、model、task_type 的嵌入器，預設為GeminiEmbedder
+    :param batch_size: 每個請求的條文數
+    :param max_in_flight: 同時進行中的請求數上限
+    :param checkpoint_dir: 檢查點目錄，中途失敗後重新執行會從檢查點續傳
+    :param save: 完成後是否以save_data儲存並刪除檢查點
+    :return: 統計資料
+    """
+    if embedder is None:
+        embedder = GeminiEmbedder()
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    law_name = law.get_law_name()
+    checkpoint = EmbeddingCheckpoint(os.path.join(checkpoint_dir, law_name + ".jsonl"))
+
+    known = get_stored_embeddings(law_name, embedder, data_dir)
+    reused_from_store = len(known)
+    known.update(checkpoint.load())
+
+    hashes = []
+    pending: dict[str, tuple[str, str]] = {}  # 雜湊 -> (內容, 標題)，相同內容只嵌入一次
+    for a in law.law_articles:
+        title = a.get_article_title(law_name)
+        h = content_hash(a.article_content, title, embedder.model, embedder.task_type)
+        hashes.append(h)
+        if h not in known and h not in pending:
+            pending[h] = (a.article_content, title)
+
+    batches = []
+    items = list(pending.items())
+    for i in range(0, len(items), batch_size):
+        batches.append(items[i:i + batch_size])
+
+    def run_batch(batch):
+        embeddings = embedder.embed_batch([c for _, (c, _) in batch], [t for _, (_, t) in batch])
+        return [h for h, _ in batch], embeddings
+
+    if len(batches) != 0:
+        with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+            in_flight = set()
+            next_batch = 0
+            error = None
+            while len(in_flight) != 0 or (error is None and next_batch < len(batches)):
+                while error is None and next_batch < len(batches) and len(in_flight) < max_in_flight:
+                    in_flight.add(executor.submit(run_batch, batches[next_batch]))
+                    next_batch += 1
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        batch_hashes, embeddings = future.result()
+                    except Exception as e:
+                        # 停止送出新批次，等進行中的批次完成並寫入檢查點後再拋出
+                        if error is None:
+                            error = e
+                        continue
+                    checkpoint.append(batch_hashes, embeddings)
+                    known.update(zip(batch_hashes, embeddings))
+            if error is not None:
+                raise error
+
+    for a, h in zip(law.law_articles, hashes):
+        a.article_embedding = known[h]
+    if save:
+        save_data(law, data_dir)
+        checkpoint.remove()
+        pending_path = get_pending_embeddings_path(law_name, data_dir)
+        if os.path.exists(pending_path):
+            os.remove(pending_path)
+    return {"articles": len(law.law_articles),
+            "embedded": len(pending),
+            "reused": len(law.law_articles) - len(pending),
+            "stored": reused_from_store,
+            "batches": len(batches)}
+
+
+def normalize_text(text: str) -> str:
+    """快取用的文字正規化：全半形統一、去除頭尾空白並合併連續空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def embedding_cache_key(text: str, model: str = EMBEDDING_MODEL, task_type: str = "retrieval_query",
+                        title: str = None) -> str:
+    return content_hash(normalize_text(text), title or "", model, task_type)
+
+
+class EmbeddingCache:
+    """
+    查詢及標籤字串的嵌入快取，鍵為 (模型, 任務類型, 標題, 正規化文字)
+    記憶體內LRU為第一層，SQLite為第二層(重新啟動後仍保留)，支援批次查詢
+    :param path: SQLite檔路徑，None表示只使用記憶體
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_memory_entries: int = 4096):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _get_db(self):
+        if self._db is None and self.path is not None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._db.commit()
+        return self._db
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: list[str]) -> dict[str, np.ndarray]:
+        result = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    result[key] = vector
+                    self.memory_hits += 1
+                elif key not in missing:
+                    missing.append(key)
+            db = self._get_db()
+            if db is not None:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = db.execute("SELECT key, vector FROM embeddings WHERE key IN ({})".format(
+                        ",".join("?" * len(chunk))), chunk).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(key, vector)
+                        result[key] = vector
+                        self.disk_hits += 1
+            self.misses += len([key for key in missing if key not in result])
+        return result
+
+    def put_many(self, items: dict[str, list[float]]):
+        with self._lock:
+            rows = []
+            for key, vector in items.items():
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((key, vector.tobytes()))
+            db = self._get_db()
+            if db is not None and len(rows) != 0:
+                db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+                db.commit()
+
+    def get_or_embed(self, texts: list[str], embed_func, model: str = EMBEDDING_MODEL,
+                     task_type: str = "retrieval_query", title: str = None) -> list[np.ndarray]:
+        """
+        批次取得嵌入向量，快取中沒有的文字去重後以一次embed_func(texts)取得並寫入快取
+        :param embed_func: 輸入文字清單，回傳對應的嵌入向量清單
+        """
+        keys = [embedding_cache_key(t, model, task_type, title) for t in texts]
+        found = self.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if len(missing) != 0:
+            embeddings = embed_func(list(missing.values()))
+            new_items = {key: np.asarray(e, dtype=np.float32) for key, e in zip(missing.keys(), embeddings)}
+            self.put_many(new_items)
+            found.update(new_items)
+        return [found[key] for key in keys]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.memory_hits + self.disk_hits + self.misses
+            return {"memory_entries": len(self._memory),
+                    "memory_hits": self.memory_hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "hit_rate": (self.memory_hits + self.disk_hits) / total if total != 0 else 0.0}
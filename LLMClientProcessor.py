@@ -0,0 +1,210 @@
+import random
+import threading
+import time
+
+from google.api_core import exceptions as core_exceptions
+
+# 暫時性的錯誤，可以重試
+RETRYABLE_ERRORS = (core_exceptions.TooManyRequests,
+                    core_exceptions.ResourceExhausted,
+                    core_exceptions.InternalServerError,
+                    core_exceptions.BadGateway,
+                    core_exceptions.ServiceUnavailable,
+                    core_exceptions.GatewayTimeout,
+                    core_exceptions.DeadlineExceeded,
+                    ConnectionError,
+                    TimeoutError)
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中，暫停呼叫模型"""
+
+
+class RateLimitTimeout(Exception):
+    """在期限內等不到速率限制的額度"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """429/5xx/逾時/連線錯誤可重試，其餘(參數錯誤、權限、內容被擋等)直接拋出"""
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class TokenBucket:
+    """
+    令牌桶速率限制
+    :param rate_per_minute: 每分鐘補充的額度
+    :param capacity: 桶的容量(可瞬間使用的最大額度)，預設等於每分鐘額度
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, amount: float = 1) -> float:
+        """
+        嘗試取得額度，成功時扣除並回傳0，否則不扣除並回傳需要等待的秒數
+        超過容量的請求視為需要整個桶
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._refill_locked(now)
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def acquire(self, amount: float = 1, timeout: float = None) -> bool:
+        """阻塞直到取得額度，超過timeout秒時回傳False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(amount)
+            if wait == 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+
+class CircuitBreaker:
+    """
+    連續失敗failure_threshold次後開啟，recovery_timeout秒內的呼叫直接失敗
+    之後進入半開狀態，只放行一個試探請求，成功則關閉、失敗則重新開啟
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def rejecting(self) -> bool:
+        """開啟中且尚未到達恢復時間"""
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self._opened_at < self.recovery_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class LLMClient:
+    """
+    所有模型呼叫(生成、嵌入、對話)共用的包裝
+    指數退避加隨機抖動並有總期限、區分可重試與不可重試的錯誤、斷路器、每分鐘請求數及token數的速率限制
+    """
+
+    def __init__(self, requests_per_minute: float = 60, tokens_per_minute: float = 1000000,
+                 max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 20, deadline: float = 60,
+                 failure_threshold: int = 5, recovery_timeout: float = 30):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.breaker = CircuitBreaker(failure_threshold, recovery_timeout)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def backoff(self, attempt: int) -> float:
+        """第attempt次重試前的等待秒數(full jitter)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, func, *args, tokens: int = 0, deadline: float = None, **kwargs):
+        """
+        呼叫func(*args, **kwargs)
+        :param tokens: 這次呼叫預估使用的token數，用於每分鐘token數限制
+        :param deadline: 總期限(秒)，包含重試及等待速率限制的時間，預設為self.deadline
+        """
+        self._count("calls")
+        self._local.retries = 0
+        end = time.monotonic() + (self.deadline if deadline is None else deadline)
+        attempt = 0
+        while True:
+            if self.breaker.rejecting():  # 先快速失敗，不必等速率限制
+                self._count("rejected")
+                raise CircuitOpenError("模型服務暫時無法使用，請稍後再試")
+            if not self.request_bucket.acquire(1, end - time.monotonic()) or \
+                    not self.token_bucket.acquire(tokens, end - time.monotonic()):
+                self._count("rejected")
+                raise RateLimitTimeout("等待速率限制逾時 [function: {}]".format(getattr(func, "__name__", func)))
+            if not self.breaker.allow():
+                self._count("rejected")
+                raise CircuitOpenError("模型服務暫時無法使用，請稍後再試")
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    self.breaker.record_success()  # 服務有回應，錯誤出在請求本身
+                    self._count("failures")
+                    raise
+                self.breaker.record_failure()
+                attempt += 1
+                delay = self.backoff(attempt)
+                # 這次失敗讓斷路器開啟時直接拋出原本的錯誤，不再等待一次注定被拒絕的重試
+                if attempt >= self.max_attempts or time.monotonic() + delay > end or self.breaker.rejecting():
+                    self._count("failures")
+                    raise
+                print("Retry [function: {}], {}".format(getattr(func, "__name__", func), e))
+                self._count("retries")
+                self._local.retries += 1
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    def last_retries(self) -> int:
+        """這個執行緒最近一次call的重試次數"""
+        return getattr(self._local, "retries", 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls,
+                    "retries": self.retries,
+                    "failures": self.failures,
+                    "rejected": self.rejected,
+                    "circuit": self.breaker.state}
@@ -1,7 +1,29 @@
 import datetime
 import json
+import mmap
+import os
+import time
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
 from typing import TextIO, Union
 
+import numpy as np
+
+DATA_DIR = "LawData"
+CHLAW_PATH = os.path.join(DATA_DIR, "ChLaw.json")
+MANIFEST_PATH = os.path.join(DATA_DIR, "manifest.json")
+EMBEDDING_DTYPE = np.float32
+
+
+class LawNotIngested(Exception):
+    """法律尚未匯入(python LawDataProcessor.py ingest)，訊息可直接顯示給使用者"""
+
+    def __init__(self, law_name: str):
+        super().__init__("系統尚未匯入{}的資料，目前無法回答，請聯絡管理員執行 python LawDataProcessor.py ingest".format(law_name))
+        self.law_name = law_name
+
 
 class Article:
     """條文物件，主要會以List的方式用在法律物件內"""
@@ -10,15 +32,41 @@ class Article:
         self.article_law_name = article_law_name
         self.article_number = article_num
         self.article_content = article_content
-        self.article_embedding = article_embedding
+        self._embedding = article_embedding
+        self._embedding_source: Union[tuple["LawData", int], None] = None  # (法律物件, 嵌入矩陣列號)，延遲讀取用
+
+    @property
+    def article_embedding(self):
+        """條文嵌入向量，從二進位檔讀取的法律會在第一次存取時才取出該列(mmap，不複製)"""
+        if self._embedding is None and self._embedding_source is not None:
+            law, row = self._embedding_source
+            matrix = law.embedding_matrix
+            if matrix is not None:
+                self._embedding = matrix[row]
+        return self._embedding
+
+    @article_embedding.setter
+    def article_embedding(self, value):
+        source = self._embedding_source
+        self._embedding = value
+        self._embedding_source = None
+        if source is not None:  # 所屬法律的mmap矩陣已不是最新的嵌入向量
+            source[0]._detach_embedding_file()
 
     def dump_to_json(self) -> Union[str, None]:
         return json.dumps(self.dict(), indent=4, ensure_ascii=False)
 
-    def dict(self):
+    def dict(self, embedding: bool = True):
+        """:param embedding: False時不含嵌入向量(不會轉成float list)"""
+        if not embedding:
+            return {"ArticleNumber": self.article_number,
+                    "ArticleContent": self.article_content}
+        embedding = self.article_embedding
+        if isinstance(embedding, np.ndarray):
+            embedding = embedding.tolist()
         return {"ArticleNumber": self.article_number,
                 "ArticleContent": self.article_content,
-                "ArticleEmbedding": self.article_embedding}
+                "ArticleEmbedding": embedding}
 
     def get_article_title(self, law_name: str):
         return law_name + " " + self.article_number
@@ -33,6 +81,79 @@ class LawData:
         self.law_modified_date = datetime.date(2000, 1, 1)
         self.law_effective_date = datetime.date(2000, 1, 1)
         self.law_articles: list[Article] = []
+        self._embedding_file = None
+        self._embedding_matrix = None
+        self._indexed_articles = None  # 建立索引時的law_articles及條數，用於判斷索引是否過期
+        self._indexed_count = 0
+        self._chapter_ranges: dict[tuple[str, str, str, str], list[list[int]]] = {}
+        self._article_by_number: dict[str, Article] = {}
+        self._table_of_articles = ""
+        self._part_headings: list[str] = []  # 每列條文所屬編的標題
+
+    @property
+    def embedding_matrix(self) -> Union[np.ndarray, None]:
+        """
+        條文嵌入矩陣(float32，每列對應law_articles的一條)
+        由二進位檔載入時以mmap延遲開啟，否則由各條文的嵌入向量組合，有條文缺少嵌入時回傳None
+        """
+        if self._embedding_file is not None:
+            if self._embedding_matrix is None:
+                self._embedding_matrix = np.load(self._embedding_file, mmap_mode='r')
+            return self._embedding_matrix
+        embeddings = [a.article_embedding for a in self.law_articles]
+        if len(embeddings) == 0 or any(e is None for e in embeddings):
+            return None
+        matrix = np.empty((len(embeddings), len(embeddings[0])), dtype=EMBEDDING_DTYPE)
+        for row, e in enumerate(embeddings):  # 逐列寫入，不先組成float64的暫存矩陣
+            matrix[row] = e
+        return matrix
+
+    def _detach_embedding_file(self):
+        """
+        條文的嵌入向量被修改時呼叫：其餘條文改為直接持有mmap矩陣的列(不複製)，
+        之後embedding_matrix由各條文的嵌入向量組成，save_data寫出的是新的向量
+        """
+        if self._embedding_file is None:
+            return
+        matrix = self.embedding_matrix
+        for a in self.law_articles:
+            if a._embedding_source is not None and a._embedding_source[0] is self:
+                if a._embedding is None:
+                    a._embedding = matrix[a._embedding_source[1]]
+                a._embedding_source = None
+        self._embedding_file = None
+        self._embedding_matrix = None
+
+    def get_law_binary_data(self, meta_file_path: str, embedding_file_path: str = None):
+        """
+        Get Law Data from binary store
+        :param meta_file_path: 中繼資料檔(法律名稱、日期、條號、條文內容)
+        :param embedding_file_path: float32嵌入矩陣(.npy)，不存在時條文沒有嵌入向量
+        """
+        with open(meta_file_path, 'r', encoding="utf-8") as f:
+            law = json.load(f)
+        self.law_name = law['LawName']
+        self.law_level = law['LawLevel']
+        self.law_modified_date = _parse_law_date(law['LawModifiedDate'])
+        self.law_effective_date = _parse_law_date(law['LawEffectiveDate'])
+        self.law_articles = []
+        has_embedding = embedding_file_path is not None and os.path.exists(embedding_file_path)
+        self._embedding_file = embedding_file_path if has_embedding else None
+        self._embedding_matrix = None
+        for row, article in enumerate(law['LawArticles']):
+            tmp = Article(self.law_name, article['ArticleNumber'], article['ArticleContent'])
+            if has_embedding:
+                tmp._embedding_source = (self, row)
+            self.law_articles.append(tmp)
+        if "ChapterRanges" in law and "ArticleNumbers" in law:
+            self._chapter_ranges = {tuple(path): ranges for path, ranges in law['ChapterRanges']}
+            self._article_by_number = {num: self.law_articles[row] for num, row in law['ArticleNumbers'].items()}
+            self._table_of_articles = law.get('TableOfArticles', "")
+            self._indexed_articles = self.law_articles
+            self._indexed_count = len(self.law_articles)
+            self._build_part_headings()
+        else:
+            self.build_indexes()
 
     def get_law_json_data(self, law_json_file: TextIO = None, law_name=""):
         """Get Law Data from json file"""
@@ -40,25 +161,7 @@ class LawData:
         try:  # 代表讀取的是全部的法條
             for law in temp['Laws']:
                 if law['LawName'] == law_name:
-                    self.law_name = law['LawName']
-                    self.law_level = law['LawLevel']
-                    try:
-                        self.law_modified_date = datetime.datetime.strptime(law['LawModifiedDate'], "%Y%m%d")
-                    except:
-                        self.law_modified_date = None
-                    try:
-                        self.law_effective_date = datetime.datetime.strptime(law['LawEffectiveDate'], "%Y%m%d")
-                    except:
-                        self.law_effective_date = None
-                    for article in law['LawArticles']:
-                        if article['ArticleType'] == "A":
-                            self.law_articles.append(Article(article_law_name=law_name,
-                                                             article_num=article['ArticleNo'],
-                                                             article_content=article['ArticleContent']))
-                        elif article['ArticleType'] == "C":
-                            self.law_articles.append(Article(article_law_name=law_name,
-                                                             article_num=article['ArticleNo'],
-                                                             article_content=article['ArticleContent']))
+                    self.get_law_dict_data(law)
         except KeyError as ke:  # 代表讀取的是嵌入過的法條檔
             law = temp
             if law['LawName'] == law_name:
@@ -79,11 +182,27 @@ class LawData:
                                                      article['ArticleEmbedding']
                                                      )
                                              )
+        self.build_indexes()
+
+    def get_law_dict_data(self, law: dict):
+        """Get Law Data from one law object of the ChLaw.json dump"""
+        law_name = law['LawName']
+        self.law_name = law_name
+        self.law_level = law['LawLevel']
+        self.law_modified_date = _parse_law_date(law['LawModifiedDate'])
+        self.law_effective_date = _parse_law_date(law['LawEffectiveDate'])
+        for article in law['LawArticles']:
+            if article['ArticleType'] in ("A", "C"):
+                self.law_articles.append(Article(article_law_name=law_name,
+                                                 article_num=article['ArticleNo'],
+                                                 article_content=article['ArticleContent']))
+        self.build_indexes()
 
-    def dict(self) -> dict:
+    def dict(self, embedding: bool = True) -> dict:
+        """:param embedding: False時條文不含嵌入向量，二進位格式的中繼資料使用"""
         articles = []
         for article in self.law_articles:
-            articles.append(article.dict())
+            articles.append(article.dict(embedding))
         modDate = ""
         effectiveDate = ""
         if self.law_modified_date is not None:
@@ -102,19 +221,82 @@ class LawData:
     def get_law_name(self):
         return self.law_name
 
-    def get_table_of_articles(self):
-        result = ""
-        for a in self.law_articles:
+    def build_indexes(self):
+        """
+        建立 編/章/節/款 目錄樹(每個路徑對應連續的條文範圍)及條號索引
+        載入時建立一次，之後章節及條號查詢只與結果大小有關
+        """
+        chapter_ranges: dict[tuple[str, str, str, str], list[list[int]]] = {}
+        article_by_number: dict[str, Article] = {}
+        table = ""
+        cur_chp = ["", "", "", ""]
+        for i, a in enumerate(self.law_articles):
             if a.article_number == "":
-                result += a.article_content + "\n"
-        return result
+                table += a.article_content + "\n"
+                if "編 " in a.article_content:
+                    cur_chp = [a.article_content.replace(" ", "").split("編")[1], "", "", ""]
+                elif "章 " in a.article_content:
+                    cur_chp = [cur_chp[0], a.article_content.replace(" ", "").split("章")[1], "", ""]
+                elif "節 " in a.article_content:
+                    cur_chp = [cur_chp[0], cur_chp[1], a.article_content.replace(" ", "").split("節")[1], ""]
+                elif "款 " in a.article_content:
+                    cur_chp = [cur_chp[0], cur_chp[1], cur_chp[2], a.article_content.replace(" ", "").split("款")[1]]
+                continue
+            article_by_number.setdefault(normalize_article_number(a.article_number), a)
+            paths = {tuple(cur_chp),
+                     (cur_chp[0], cur_chp[1], cur_chp[2], ""),
+                     (cur_chp[0], cur_chp[1], "", ""),
+                     (cur_chp[0], "", "", "")}
+            for path in paths:
+                ranges = chapter_ranges.setdefault(path, [])
+                if len(ranges) != 0 and ranges[-1][1] == i:
+                    ranges[-1][1] = i + 1
+                else:
+                    ranges.append([i, i + 1])
+        self._chapter_ranges = chapter_ranges
+        self._article_by_number = article_by_number
+        self._table_of_articles = table
+        self._indexed_articles = self.law_articles
+        self._indexed_count = len(self.law_articles)
+        self._build_part_headings()
+
+    def _build_part_headings(self):
+        """由目錄及編的條文範圍建立每列條文所屬編的標題"""
+        headings = {}
+        for line in self._table_of_articles.splitlines():
+            if "編 " in line:
+                headings.setdefault(line.replace(" ", "").split("編")[1], line.strip())
+        part_headings = [""] * len(self.law_articles)
+        for path, ranges in self._chapter_ranges.items():
+            if path[0] == "" or path[1:] != ("", "", ""):
+                continue
+            heading = headings.get(path[0], "")
+            for start, end in ranges:
+                part_headings[start:end] = [heading] * (end - start)
+        self._part_headings = part_headings
+
+    def _ensure_indexes(self):
+        if self._indexed_articles is not self.law_articles or self._indexed_count != len(self.law_articles):
+            self.build_indexes()
+
+    def get_table_of_articles(self):
+        self._ensure_indexes()
+        return self._table_of_articles
+
+    def get_part_headings(self, rows: list[int]) -> list[str]:
+        """
+        條文列號所屬編的標題(目錄中的原文，例如"第二編 債")，不屬於任何編時為空字串
+        """
+        self._ensure_indexes()
+        return [self._part_headings[row] for row in rows]
 
     def get_article_by_num(self, num: str):
-        num = num.replace('N', "")
-        for a in self.law_articles:
-            if num in a.article_number:
-                return a
-        return None
+        """
+        :param num: 條號，可為 "N123-1"、"第 123-1 條"、"第一百二十三條之一" 等形式
+        :return: 條號完全相符的條文，找不到時回傳None
+        """
+        self._ensure_indexes()
+        return self._article_by_number.get(normalize_article_number(num))
 
     def get_articles_by_chapters(self, chapters: list[list[str]]):
         """
@@ -122,36 +304,141 @@ class LawData:
         :param chapters: 由清單元素組成，每一清單元素包含4個字串元素，分別代表 編 章 節 款
         :return: 輸出一個由article組成的清單，代表包含在編 章 節 款中的法條
         """
+        self._ensure_indexes()
+        ranges = []
+        for c in chapters:
+            ranges.extend(self._chapter_ranges.get(tuple(c), []))
+        ranges.sort()
         result = []
-        cur_chp = ["", "", "", ""]
-        for a in self.law_articles:
-            if a.article_number == "":
-                if "編 " in a.article_content:
-                    cur_chp[0] = a.article_content.replace(" ", "").split("編")[1]
-                    cur_chp[1] = ""
-                    cur_chp[2] = ""
-                    cur_chp[3] = ""
-                elif "章 " in a.article_content:
-                    cur_chp[1] = a.article_content.replace(" ", "").split("章")[1]
-                    cur_chp[2] = ""
-                    cur_chp[3] = ""
-                elif "節 " in a.article_content:
-                    cur_chp[2] = a.article_content.replace(" ", "").split("節")[1]
-                    cur_chp[3] = ""
-                elif "款 " in a.article_content:
-                    cur_chp[3] = a.article_content.replace(" ", "").split("款")[1]
-            else:
-                if cur_chp in chapters:
-                    result.append(a)
-                elif [cur_chp[0], cur_chp[1], cur_chp[2], ""] in chapters:
-                    result.append(a)
-                elif [cur_chp[0], cur_chp[1], "", ""] in chapters:
-                    result.append(a)
-                elif [cur_chp[0], "", "", ""] in chapters:
-                    result.append(a)
+        end = 0
+        for r in ranges:
+            start = max(r[0], end)
+            if start < r[1]:
+                result.extend(self.law_articles[start:r[1]])
+                end = r[1]
         return result
 
 
+_CHINESE_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "兩": 2, "三": 3, "四": 4, "五": 5,
+                   "六": 6, "七": 7, "八": 8, "九": 9}
+_CHINESE_UNITS = {"十": 10, "百": 100, "千": 1000, "萬": 10000}
+
+
+def chinese_to_int(text: str) -> Union[int, None]:
+    """將中文數字(例如 一百八十四、一千零一)轉為整數，無法轉換時回傳None"""
+    if text == "":
+        return None
+    total = 0
+    section = 0
+    digit = None
+    for ch in text:
+        if ch in _CHINESE_DIGITS:
+            digit = _CHINESE_DIGITS[ch]
+        elif ch in _CHINESE_UNITS:
+            unit = _CHINESE_UNITS[ch]
+            if unit == 10000:
+                total += (section + (digit or 0)) * unit
+                section = 0
+            else:
+                section += (1 if digit is None else digit) * unit
+            digit = None
+        else:
+            return None
+    return total + section + (digit or 0)
+
+
+def normalize_article_number(num: str) -> str:
+    """
+    將條號正規化為 "123" 或 "123-1" 的形式
+    支援 N123-1、第 123-1 條、第123條之1、第一百二十三條之一、全形數字等寫法
+    """
+    num = unicodedata.normalize("NFKC", num)
+    for s in ("N", "第", "條", "號", " "):
+        num = num.replace(s, "")
+    num = num.replace("之", "-").strip("-")
+    parts = []
+    for part in num.split("-"):
+        if not part.isdigit():
+            value = chinese_to_int(part)
+            part = str(value) if value is not None else part
+        parts.append(str(int(part)) if part.isdigit() else part)
+    return "-".join(parts)
+
+
+_ARTICLE_REF_TOKEN = re.compile(r"(?P<num>[0-9]+|[零〇一二兩三四五六七八九十百千]+)|(?P<sub>之|-)|(?P<range>至|到|~)"
+                                r"|(?P<sep>、|,|及|與|和|或)|(?P<di>第)|(?P<tiao>條)|(?P<space>\s+)|(?P<other>.)")
+MAX_ARTICLE_RANGE = 100
+
+
+def parse_article_references(text: str) -> list[str]:
+    """
+    從問題中找出指定的條號，不需呼叫LLM
+    支援 第184條、第123-1條、第123條之1、第一百八十四條、範圍(第184條至第186條、第184到186條)
+    及清單(第184、185條、第184條及第185條)
+    :return: 正規化後的條號清單(例如 ["184", "123-1"])，依出現順序且不重複
+    """
+    text = unicodedata.normalize("NFKC", text)
+    refs: list[list] = []  # [主號, 之號, 是否為範圍的結尾]
+    pending: list[list] = []  # 尚未遇到「條」的條號
+    active = False
+    after_tiao = False
+    in_range = False
+    sub_target = None
+    for m in _ARTICLE_REF_TOKEN.finditer(text):
+        kind = m.lastgroup
+        if kind == "space":
+            continue
+        if kind == "di":
+            active = True
+            after_tiao = False
+            continue
+        if not active:
+            continue
+        if kind == "num":
+            if sub_target is not None:
+                sub_target[1] = m.group()
+                sub_target = None
+            else:
+                pending.append([m.group(), None, in_range])
+                in_range = False
+                after_tiao = False
+        elif kind == "sub" and sub_target is None and (len(pending) != 0 or after_tiao):
+            sub_target = pending[-1] if len(pending) != 0 else refs[-1]
+        elif kind == "range":
+            in_range = True
+        elif kind == "sep":
+            after_tiao = False
+        elif kind == "tiao" and len(pending) != 0:
+            refs.extend(pending)
+            pending = []
+            after_tiao = True
+        else:  # 其他文字結束目前的條號序列，沒有「條」的數字(例如第1項)不採用
+            pending = []
+            active = after_tiao = in_range = False
+            sub_target = None
+
+    result = []
+    prev = None
+    for num, sub, is_range_end in refs:
+        cur = normalize_article_number(num if sub is None else num + "-" + sub)
+        if is_range_end and prev is not None and prev.isdigit() and cur.isdigit() \
+                and 0 < int(cur) - int(prev) <= MAX_ARTICLE_RANGE:
+            for n in range(int(prev) + 1, int(cur)):
+                if str(n) not in result:
+                    result.append(str(n))
+        if cur != "" and cur not in result:
+            result.append(cur)
+        prev = cur
+    return result
+
+
+def _parse_law_date(date_str: str):
+    try:
+        return datetime.datetime.strptime(date_str, "%Y%m%d")
+    except (TypeError, ValueError):
+        return None
+
+
 def analyze_chapter(chp_str: str):
     chp_str = chp_str.replace("C", "")
     result = ["", "", "", ""]
@@ -168,25 +455,513 @@ def analyze_chapter(chp_str: str):
     return result
 
 
+def get_data_paths(law_name: str, data_dir: str = DATA_DIR) -> tuple[str, str, str]:
+    """回傳 (中繼資料檔, 嵌入矩陣檔, 舊版JSON檔) 的路徑"""
+    base = os.path.join(data_dir, str(law_name))
+    return base + ".meta.json", base + ".npy", base + ".json"
+
+
+def get_pending_embeddings_path(law_name: str, data_dir: str = DATA_DIR) -> str:
+    """條文異動後尚未重新嵌入時，保存未變動條文原有嵌入向量的檔案"""
+    return os.path.join(data_dir, str(law_name)) + ".pending.npz"
+
+
+def save_pending_embeddings(law_name: str, keys: list[tuple[str, str]], matrix: np.ndarray,
+                            data_dir: str = DATA_DIR):
+    """
+    :param keys: 各列的 (條號, 條文內容)
+    :param matrix: 對應的嵌入向量
+    """
+    numbers = np.array([k[0] for k in keys], dtype=str)
+    contents = np.array([k[1] for k in keys], dtype=str)
+    embeddings = np.asarray(matrix, dtype=EMBEDDING_DTYPE)
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as fp:
+            np.savez(fp, numbers=numbers, contents=contents, embeddings=embeddings)
+    _atomic_write(get_pending_embeddings_path(law_name, data_dir), write)
+
+
+def load_pending_embeddings(law_name: str, data_dir: str = DATA_DIR) -> list[tuple[str, str, np.ndarray]]:
+    """:return: [(條號, 條文內容, 嵌入向量), ...]，沒有檔案時回傳空清單"""
+    path = get_pending_embeddings_path(law_name, data_dir)
+    if not os.path.exists(path):
+        return []
+    with np.load(path) as data:
+        return list(zip(data["numbers"].tolist(), data["contents"].tolist(), data["embeddings"]))
+
+
 def load_data(law_name: str) -> Union[LawData, None]:
+    meta_path, npy_path, json_path = get_data_paths(law_name)
+    if os.path.exists(meta_path):
+        tmp = LawData()
+        tmp.get_law_binary_data(meta_path, npy_path)
+        return tmp
     try:
-        with open("LawData/" + str(law_name) + ".json", 'r', encoding="utf-8") as f:
+        with open(json_path, 'r', encoding="utf-8") as f:
             tmp = LawData()
             tmp.get_law_json_data(f, law_name)
             return tmp
     except FileNotFoundError as e_noFile:
+        if os.getenv("LAZY_INGESTION", "0") != "1":
+            print("法律 {} 尚未匯入，請先執行 python LawDataProcessor.py ingest".format(law_name))
+            return None
         try:
-            with open("LawData/ChLaw.json", 'r', encoding="utf-8-sig") as f:
-                tmp = LawData()
-                tmp.get_law_json_data(f, law_name)
-                from AIProcessor import embedding_all_articles
-                embedding_all_articles(tmp)
-                return tmp
+            law = read_chlaw_law(law_name)
+            if law is None:
+                raise KeyError("法律 {} 不在 {} 內".format(law_name, CHLAW_PATH))
+            tmp = LawData()
+            tmp.get_law_dict_data(law)
+            from AIProcessor import embedding_all_articles
+            embedding_all_articles(tmp)
+            return tmp
         except Exception as e:
             print(e)
             return None
 
 
-def save_data(data: LawData):
-    with open("LawData/" + str(data.law_name + ".json"), 'w', encoding="utf-8") as fp:
-        json.dump(data.dict(), fp, ensure_ascii=False, indent=4)
+_CHLAW_TOKEN = re.compile(rb'["{}\[\]]')
+_CHLAW_STRING_END = re.compile(rb'["\\]')
+
+
+def iter_chlaw_spans(path: str = CHLAW_PATH):
+    """
+    以mmap逐段掃描ChLaw.json，依序產生 "Laws" 陣列中每部法律物件的 (位元組偏移, 長度)
+    不解析整份文件；UTF-8的多位元組字元不會包含 引號、括號、反斜線等ASCII位元組，可直接以位元組掃描
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            depth = 0
+            in_laws = False
+            law_start = None
+            last_key = None
+            while True:
+                m = _CHLAW_TOKEN.search(mm, pos)
+                if m is None:
+                    break
+                c = m.group()
+                p = m.start()
+                if c == b'"':
+                    q = p + 1
+                    while True:
+                        m_end = _CHLAW_STRING_END.search(mm, q)
+                        if m_end is None:
+                            return
+                        if mm[m_end.start()] == ord('\\'):
+                            q = m_end.start() + 2
+                            continue
+                        break
+                    if depth == 1:
+                        last_key = mm[p + 1:m_end.start()]
+                    pos = m_end.start() + 1
+                    continue
+                if c == b'[' or c == b'{':
+                    depth += 1
+                    if c == b'[' and depth == 2 and last_key == b'Laws':
+                        in_laws = True
+                    elif c == b'{' and depth == 3 and in_laws:
+                        law_start = p
+                else:
+                    if c == b'}' and depth == 3 and law_start is not None:
+                        yield law_start, p + 1 - law_start
+                        law_start = None
+                    elif c == b']' and depth == 2:
+                        in_laws = False
+                    depth -= 1
+                pos = p + 1
+
+
+def _read_chlaw_span(f, offset: int, length: int) -> dict:
+    f.seek(offset)
+    return json.loads(f.read(length).decode("utf-8"))
+
+
+def iter_chlaw_laws(path: str = CHLAW_PATH):
+    """串流讀取ChLaw.json，一次產生一部法律的dict"""
+    with open(path, 'rb') as f:
+        for offset, length in iter_chlaw_spans(path):
+            yield _read_chlaw_span(f, offset, length)
+
+
+def get_chlaw_index_path(path: str = CHLAW_PATH) -> str:
+    return path + ".index.json"
+
+
+def build_chlaw_index(path: str = CHLAW_PATH) -> dict:
+    """建立並儲存 LawName -> [位元組偏移, 長度] 的索引，附上原檔的mtime及大小以判斷是否過期"""
+    st = os.stat(path)
+    laws = {}
+    with open(path, 'rb') as f:
+        for offset, length in iter_chlaw_spans(path):
+            laws[_read_chlaw_span(f, offset, length)['LawName']] = [offset, length]
+    index = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "Laws": laws}
+
+    def write_index(tmp_path):
+        with open(tmp_path, 'w', encoding="utf-8") as fp:
+            json.dump(index, fp, ensure_ascii=False)
+    _atomic_write(get_chlaw_index_path(path), write_index)
+    return index
+
+
+_chlaw_index_lock = threading.Lock()
+_chlaw_indexes: dict[str, dict] = {}
+
+
+def load_chlaw_index(path: str = CHLAW_PATH) -> dict:
+    """取得ChLaw.json的索引，索引檔不存在或與原檔不符時重新建立"""
+    st = os.stat(path)
+    with _chlaw_index_lock:
+        index = _chlaw_indexes.get(path)
+        if index is None or index["mtime_ns"] != st.st_mtime_ns or index["size"] != st.st_size:
+            index = None
+            try:
+                with open(get_chlaw_index_path(path), 'r', encoding="utf-8") as f:
+                    index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+            if index is None or index.get("mtime_ns") != st.st_mtime_ns or index.get("size") != st.st_size:
+                index = build_chlaw_index(path)
+            _chlaw_indexes[path] = index
+        return index
+
+
+def read_chlaw_law(law_name: str, path: str = CHLAW_PATH) -> Union[dict, None]:
+    """由索引直接讀取單一法律，時間及記憶體只與該法律的大小有關"""
+    span = load_chlaw_index(path)["Laws"].get(law_name)
+    if span is None:
+        return None
+    with open(path, 'rb') as f:
+        return _read_chlaw_span(f, span[0], span[1])
+
+
+def _atomic_write(path: str, write_func):
+    """先寫入暫存檔再取代，避免覆寫到正在被mmap的檔案"""
+    tmp_path = path + ".tmp"
+    write_func(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_data(data: LawData, data_dir: str = DATA_DIR):
+    """
+    以二進位格式儲存法律資料：嵌入向量存成連續的float32 .npy矩陣，其餘資料存成中繼資料檔
+    """
+    meta_path, npy_path, _ = get_data_paths(data.law_name, data_dir)
+    meta = data.dict(embedding=False)  # 嵌入向量直接由矩陣寫入，不經過float list
+    # 章節、條號索引也一併存入，載入時不需重建
+    data._ensure_indexes()
+    rows = {id(a): i for i, a in enumerate(data.law_articles)}
+    meta['TableOfArticles'] = data._table_of_articles
+    meta['ChapterRanges'] = [[list(path), ranges] for path, ranges in data._chapter_ranges.items()]
+    meta['ArticleNumbers'] = {num: rows[id(a)] for num, a in data._article_by_number.items()}
+    matrix = data.embedding_matrix
+    meta['EmbeddingDim'] = 0 if matrix is None else int(matrix.shape[1])
+
+    if matrix is not None:
+        matrix = np.ascontiguousarray(matrix, dtype=EMBEDDING_DTYPE)
+
+        def write_matrix(path):
+            with open(path, 'wb') as fp:
+                np.save(fp, matrix)
+        _atomic_write(npy_path, write_matrix)
+    elif os.path.exists(npy_path):
+        os.remove(npy_path)
+
+    def write_meta(path):
+        with open(path, 'w', encoding="utf-8") as fp:
+            json.dump(meta, fp, ensure_ascii=False)
+    _atomic_write(meta_path, write_meta)
+
+
+def convert_json_data(data_dir: str = DATA_DIR) -> list[str]:
+    """
+    一次性轉換：將LawData內舊版(indent=4 JSON)的法律資料檔轉換為二進位格式
+    :return: 轉換完成的法律名稱
+    """
+    converted = []
+    for file_name in sorted(os.listdir(data_dir)):
+        if not file_name.endswith(".json") or file_name.endswith(".meta.json") or file_name == "ChLaw.json":
+            continue
+        law_name = file_name[:-len(".json")]
+        if law_name == "":
+            continue
+        with open(os.path.join(data_dir, file_name), 'r', encoding="utf-8") as f:
+            tmp = LawData()
+            tmp.get_law_json_data(f, law_name)
+        if tmp.law_name != law_name:
+            continue
+        save_data(tmp, data_dir)
+        converted.append(law_name)
+    return converted
+
+
+
+def _ingest_law(law_dict: dict, data_dir: str) -> dict:
+    """
+    將ChLaw.json中的一部法律寫成二進位格式並預先建立索引，回傳清單(manifest)的項目
+    內容未變的法律不重寫；條文有變動時沿用相同條號及內容的嵌入向量
+    有新增或修改的條文時仍寫入新的條文(暫時沒有嵌入向量，標記為stale)，不繼續提供過時的條文，
+    未變動條文的嵌入向量另存到get_pending_embeddings_path，嵌入時沿用，不丟棄已付費取得的嵌入
+    """
+    from LexicalIndexProcessor import get_lexical_index  # LexicalIndexProcessor匯入本模組，避免循環匯入
+    law = LawData()
+    law.get_law_dict_data(law_dict)
+    entry = {"LawName": law.law_name,
+             "LawLevel": law.law_level,
+             "LawModifiedDate": law_dict.get('LawModifiedDate', ""),
+             "Articles": len(law.law_articles)}
+    meta_path, npy_path, _ = get_data_paths(law.law_name, data_dir)
+    status = "new"
+    if os.path.exists(meta_path):
+        stored = LawData()
+        stored.get_law_binary_data(meta_path, npy_path)
+        keys = [(a.article_number, a.article_content) for a in law.law_articles]
+        stored_keys = [(a.article_number, a.article_content) for a in stored.law_articles]
+        if keys == stored_keys and stored.law_modified_date == law.law_modified_date:
+            get_lexical_index(stored, data_dir)
+            entry.update(Status="unchanged", Embedded=stored.embedding_matrix is not None)
+            return entry
+        matrix = stored.embedding_matrix
+        status = "updated"
+        if matrix is not None:
+            rows = {key: i for i, key in enumerate(stored_keys)}
+            if any(key not in rows for key in keys):
+                kept = [rows[key] for key in keys if key in rows]
+                save_pending_embeddings(law.law_name, [stored_keys[i] for i in kept], matrix[kept], data_dir)
+                status = "stale"
+            else:
+                for a, key in zip(law.law_articles, keys):
+                    a.article_embedding = np.asarray(matrix[rows[key]], dtype=EMBEDDING_DTYPE)
+    save_data(law, data_dir)
+    get_lexical_index(law, data_dir)
+    entry.update(Status=status, Embedded=law.embedding_matrix is not None)
+    return entry
+
+
+def _ingest_chlaw_spans(path: str, spans: list[tuple[int, int]], data_dir: str) -> list[dict]:
+    """工作行程：處理一批法律"""
+    entries = []
+    with open(path, 'rb') as f:
+        for offset, length in spans:
+            try:
+                law_dict = _read_chlaw_span(f, offset, length)
+            except ValueError as e:
+                entries.append({"LawName": "", "Status": "error", "Error": "offset {}: {}".format(offset, e)})
+                continue
+            try:
+                entries.append(_ingest_law(law_dict, data_dir))
+            except Exception as e:
+                entries.append({"LawName": law_dict.get('LawName', ""), "Status": "error", "Error": str(e)})
+    return entries
+
+
+def write_manifest(manifest: dict, path: str = MANIFEST_PATH):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding="utf-8") as fp:
+            json.dump(manifest, fp, ensure_ascii=False, indent=1)
+    _atomic_write(path, write)
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> Union[dict, None]:
+    try:
+        with open(path, 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def ingest_chlaw(path: str = CHLAW_PATH, data_dir: str = DATA_DIR, workers: int = None, batch_size: int = 64,
+                 embed: bool = False) -> dict:
+    """
+    離線匯入：將ChLaw.json拆成各法律的二進位資料檔，並預先建立章節、條號、BM25索引
+    解析及正規化以多個行程並行；embed=True時接著嵌入缺少嵌入向量的法律並重建ANN索引
+    最後寫出清單 {data_dir}/manifest.json (各法律的修正日期、條數、是否已嵌入)
+    :param workers: 行程數，預設為CPU數
+    :param batch_size: 每個工作一次處理的法律數
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    start = time.monotonic()
+    st = os.stat(path)
+    spans = list(iter_chlaw_spans(path))
+    batches = [spans[i:i + batch_size] for i in range(0, len(spans), batch_size)]
+    entries = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_ingest_chlaw_spans, path, batch, data_dir) for batch in batches]
+        for done, future in enumerate(as_completed(futures), start=1):
+            entries.extend(future.result())
+            print("[ingest_chlaw]: {}/{} 批".format(done, len(futures)))
+    build_chlaw_index(path)
+
+    if embed:
+        from AIProcessor import embedding_all_articles
+        for entry in entries:
+            if entry["Status"] == "error" or entry["Embedded"]:
+                continue
+            law = read_chlaw_law(entry["LawName"], path)
+            tmp = LawData()
+            tmp.get_law_dict_data(law)
+            try:
+                embedding_all_articles(tmp, update_ann=False, data_dir=data_dir)  # ANN索引在全部嵌入後重建一次
+            except Exception as e:
+                print("[ingest_chlaw]: 無法嵌入 {}: {}".format(entry["LawName"], e))
+                continue
+            entry.update(Status="embedded", Embedded=True)
+        import AnnIndexProcessor
+        if any(entry.get("Embedded") for entry in entries):
+            AnnIndexProcessor.build_ann_index(data_dir)
+
+    manifest = {"Source": path,
+                "SourceMtimeNs": st.st_mtime_ns,
+                "SourceSize": st.st_size,
+                "GeneratedAt": datetime.datetime.now().isoformat(timespec="seconds"),
+                "ElapsedSeconds": round(time.monotonic() - start, 3),
+                "Laws": {e["LawName"]: {k: v for k, v in e.items() if k != "LawName"} for e in entries
+                         if e["LawName"] != ""}}
+    errors = [e for e in entries if e["Status"] == "error"]
+    if len(errors) != 0:
+        manifest["Errors"] = errors
+    write_manifest(manifest, os.path.join(data_dir, "manifest.json"))
+    return manifest
+
+
+def get_data_signature(law_name: str, data_dir: str = DATA_DIR) -> Union[tuple, None]:
+    """回傳法律資料檔的 (路徑, mtime, 大小)，用於判斷快取是否過期；沒有對應檔案時回傳None"""
+    meta_path, npy_path, json_path = get_data_paths(law_name, data_dir)
+    paths = [meta_path, npy_path] if os.path.exists(meta_path) else [json_path]
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        signature.append((path, st.st_mtime_ns, st.st_size))
+    return tuple(signature) if len(signature) != 0 else None
+
+
+def _estimate_law_size(data: LawData) -> int:
+    """粗估法律物件佔用的記憶體(條文文字及非mmap的嵌入向量)"""
+    size = 0
+    for a in data.law_articles:
+        size += 100 + 4 * (len(a.article_content) + len(a.article_number))
+        if a._embedding is not None and not isinstance(a._embedding, np.memmap):
+            size += 8 * len(a._embedding)
+    return size
+
+
+class LawRegistry:
+    """
+    行程內共用的LawData快取，以法律名稱為鍵
+    檔案的mtime或大小改變時重新載入，超過數量或記憶體上限時以LRU淘汰，可在多個Gradio worker執行緒間共用
+    取得的LawData為共用物件，呼叫端不應修改
+    """
+
+    def __init__(self, max_entries: int = 32, max_bytes: int = 512 * 1024 * 1024, loader=None,
+                 data_dir: str = DATA_DIR):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.data_dir = data_dir
+        self._loader = loader if loader is not None else load_data
+        self._entries: OrderedDict[str, tuple[LawData, Union[tuple, None], int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading_locks: dict[str, threading.Lock] = {}
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def get(self, law_name: str) -> Union[LawData, None]:
+        signature = get_data_signature(law_name, self.data_dir)
+        with self._lock:
+            entry = self._entries.get(law_name)
+            if entry is not None and entry[1] == signature:
+                self._entries.move_to_end(law_name)
+                self.hits += 1
+                return entry[0]
+            loading_lock = self._loading_locks.setdefault(law_name, threading.Lock())
+        with loading_lock:  # 同一部法律只讓一個執行緒載入
+            signature = get_data_signature(law_name, self.data_dir)
+            with self._lock:
+                entry = self._entries.get(law_name)
+                if entry is not None and entry[1] == signature:
+                    self._entries.move_to_end(law_name)
+                    self.hits += 1
+                    return entry[0]
+                self.misses += 1
+                if entry is not None:
+                    self.reloads += 1
+            data = self._loader(law_name)
+            if data is None:
+                return None
+            # 載入過程可能產生新檔(例如從ChLaw.json嵌入後儲存)，以載入後的狀態為準
+            signature = get_data_signature(law_name, self.data_dir)
+            self._put(law_name, data, signature)
+            return data
+
+    def _put(self, law_name: str, data: LawData, signature):
+        size = _estimate_law_size(data)
+        with self._lock:
+            old = self._entries.pop(law_name, None)
+            if old is not None:
+                self._total_bytes -= old[2]
+            self._entries[law_name] = (data, signature, size)
+            self._total_bytes += size
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries
+                                              or self._total_bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted[2]
+                self.evictions += 1
+
+    def invalidate(self, law_name: str = None):
+        """清除指定法律的快取，未指定時清除全部"""
+        with self._lock:
+            if law_name is None:
+                self._entries.clear()
+                self._total_bytes = 0
+            else:
+                old = self._entries.pop(law_name, None)
+                if old is not None:
+                    self._total_bytes -= old[2]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "bytes": self._total_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "reloads": self.reloads,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / total if total != 0 else 0.0}
+
+
+law_registry = LawRegistry()
+
+
+def get_law(law_name: str) -> Union[LawData, None]:
+    """由行程共用的law_registry取得法律資料"""
+    return law_registry.get(law_name)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="法律資料轉換及匯入")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("convert", help="將LawData內舊版JSON資料檔轉為二進位格式(預設)")
+    ingest_parser = subparsers.add_parser("ingest", help="由ChLaw.json匯入所有法律")
+    ingest_parser.add_argument("--source", default=CHLAW_PATH)
+    ingest_parser.add_argument("--data-dir", default=DATA_DIR)
+    ingest_parser.add_argument("--workers", type=int, default=None)
+    ingest_parser.add_argument("--embed", action="store_true", help="嵌入缺少嵌入向量的法律並重建ANN索引")
+    args = parser.parse_args()
+    if args.command == "ingest":
+        result = ingest_chlaw(args.source, args.data_dir, args.workers, embed=args.embed)
+        counts = {}
+        for info in result["Laws"].values():
+            counts[info["Status"]] = counts.get(info["Status"], 0) + 1
+        print("[ingest_chlaw]: {} 部法律 {}，{} 秒".format(len(result["Laws"]), counts, result["ElapsedSeconds"]))
+    else:
+        for name in convert_json_data():
+            print("[convert_json_data]:" + name)
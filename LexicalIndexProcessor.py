@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+import weakref
+from collections import Counter
+from typing import Union
+
+import numpy as np
+
+from LawDataProcessor import DATA_DIR, Article, LawData
+from RetrievalProcessor import RetrievalResult, select_top_k
+
+NGRAM_SIZES = (1, 2)
+INDEX_VERSION = 1
+
+
+def normalize_text(text: str) -> str:
+    """全形轉半形、英文轉小寫，只保留文字及數字(標點、空白都不列入索引)"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(c for c in text if c.isalnum())
+
+
+def char_ngrams(text: str, sizes: tuple = NGRAM_SIZES) -> list[str]:
+    """字元n-gram，中文不需要斷詞"""
+    text = normalize_text(text)
+    grams = []
+    for n in sizes:
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+def article_text(article: Article) -> str:
+    """索引的內容：法律名稱、條號及條文"""
+    return article.article_law_name + article.article_number + article.article_content
+
+
+def get_lexical_index_path(law_name: str, data_dir: str = DATA_DIR) -> str:
+    return os.path.join(data_dir, str(law_name) + ".bm25.npz")
+
+
+def law_signature(law: LawData) -> str:
+    """法律內容的雜湊，內容改變時需要重建索引"""
+    h = hashlib.sha1()
+    h.update("{}\0{}\0{}\0{}".format(INDEX_VERSION, NGRAM_SIZES, law.law_name, law.law_modified_date).encode("utf-8"))
+    for a in law.law_articles:
+        h.update(b"\0")
+        h.update(article_text(a).encode("utf-8"))
+    return h.hexdigest()
+
+
+class BM25Index:
+    """
+    條文的字元n-gram BM25倒排索引
+    每個詞的posting為(條文索引, 詞頻)陣列，查詢時只累加出現在查詢中的詞的posting
+    """
+
+    def __init__(self, terms: dict[str, int], offsets: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray,
+                 doc_len: np.ndarray, signature: str = "", k1: float = 1.2, b: float = 0.75):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.signature = signature
+        self.k1 = k1
+        self.b = b
+        self.articles: list[Article] = []
+        n = len(doc_len)
+        df = np.diff(offsets).astype(np.float64)
+        self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(doc_len.mean()) if n != 0 else 0.0
+        self.norm = (k1 * (1 - b + b * doc_len / avgdl)).astype(np.float32) if avgdl != 0 else \
+            np.full(n, k1, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    @classmethod
+    def build(cls, texts: list[str], signature: str = "", **kwargs) -> "BM25Index":
+        postings: dict[str, list[tuple[int, int]]] = {}
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            counts = Counter(char_ngrams(text))
+            doc_len[doc_id] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+        terms = {}
+        offsets = [0]
+        doc_ids = []
+        tfs = []
+        for i, (term, plist) in enumerate(postings.items()):
+            terms[term] = i
+            doc_ids.extend(p[0] for p in plist)
+            tfs.extend(p[1] for p in plist)
+            offsets.append(len(doc_ids))
+        return cls(terms, np.asarray(offsets, dtype=np.int64), np.asarray(doc_ids, dtype=np.int32),
+                   np.asarray(tfs, dtype=np.float32), doc_len, signature, **kwargs)
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.doc_len), dtype=np.float32)
+        for term, qtf in Counter(char_ngrams(query)).items():
+            i = self.terms.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            ids = self.doc_ids[start:end]
+            tf = self.tfs[start:end]
+            scores[ids] += qtf * self.idf[i] * tf * (self.k1 + 1) / (tf + self.norm[ids])
+        return scores
+
+    def search(self, query: str, top_k: int = 100) -> RetrievalResult:
+        """回傳分數大於0的前top_k條"""
+        scores = self.scores(query)
+        idx = select_top_k(scores, top_k, threshold=1e-9)
+        return RetrievalResult([self.articles[i] for i in idx], scores[idx])
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, terms=np.asarray(list(self.terms), dtype=str), offsets=self.offsets,
+                 doc_ids=self.doc_ids, tfs=self.tfs, doc_len=self.doc_len,
+                 meta=np.asarray(json.dumps({"signature": self.signature, "k1": self.k1, "b": self.b})))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            terms = {t: i for i, t in enumerate(data["terms"].tolist())}
+            return cls(terms, data["offsets"], data["doc_ids"], data["tfs"], data["doc_len"], meta["signature"],
+                       meta["k1"], meta["b"])
+
+
+_index_lock = threading.Lock()
+_law_indexes: "weakref.WeakKeyDictionary[LawData, BM25Index]" = weakref.WeakKeyDictionary()
+
+
+def get_lexical_index(law: LawData, data_dir: str = DATA_DIR, save: bool = True) -> BM25Index:
+    """
+    取得法律的BM25索引：同一個LawData物件只建立一次，並存成 {法律名稱}.bm25.npz
+    磁碟上的索引內容雜湊與目前條文不同時重建
+    """
+    with _index_lock:
+        index = _law_indexes.get(law)
+    if index is not None:
+        return index
+    path = get_lexical_index_path(law.law_name, data_dir)
+    signature = law_signature(law)
+    index = None
+    if os.path.exists(path):
+        try:
+            index = BM25Index.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            print("無法讀取BM25索引 {}: {}".format(path, e))
+        if index is not None and (index.signature != signature or len(index) != len(law.law_articles)):
+            index = None
+    if index is None:
+        index = BM25Index.build([article_text(a) for a in law.law_articles], signature)
+        if save and os.path.isdir(data_dir):
+            index.save(path)
+    index.articles = law.law_articles
+    with _index_lock:
+        _law_indexes[law] = index
+    return index
+
+
+def search_lexical(query: str, laws: Union[LawData, list[LawData]], top_k: int = 100) -> RetrievalResult:
+    """在一或多部法律中以BM25檢索，不呼叫任何API"""
+    if isinstance(laws, LawData):
+        laws = [laws]
+    articles = []
+    scores = []
+    for law in laws:
+        if law is None:
+            continue
+        result = get_lexical_index(law).search(query, top_k)
+        articles.extend(result.articles)
+        scores.append(result.scores)
+    if len(articles) == 0:
+        return RetrievalResult([], np.zeros(0, dtype=np.float32))
+    scores = np.concatenate(scores)
+    idx = select_top_k(scores, top_k)
+    return RetrievalResult([articles[i] for i in idx], scores[idx])
+
+
+def reciprocal_rank_fusion(rankings: list[list[Article]], k: int = 60, weights: list[float] = None,
+                           top_k: int = None) -> RetrievalResult:
+    """
+    倒數排名融合：每個排名中第r名(由1開始)的條文得到 weight / (k + r)，加總後排序
+    :param rankings: 各檢索方式依相關度排序的條文
+    :param k: 平滑常數，越大則排名前後的差距越小
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused: dict[int, list] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, article in enumerate(ranking, start=1):
+            entry = fused.get(id(article))
+            if entry is None:
+                entry = fused[id(article)] = [article, 0.0]
+            entry[1] += weight / (k + rank)
+    entries = sorted(fused.values(), key=lambda e: -e[1])
+    if top_k is not None:
+        entries = entries[:top_k]
+    return RetrievalResult([e[0] for e in entries], np.asarray([e[1] for e in entries], dtype=np.float32))
+
+
+if __name__ == '__main__':
+    import LawDataProcessor
+    for file_name in sorted(os.listdir(DATA_DIR)):
+        if file_name.endswith(".meta.json"):
+            law = LawDataProcessor.load_data(file_name[:-len(".meta.json")])
+            print(law.law_name, len(get_lexical_index(law)), "articles indexed")
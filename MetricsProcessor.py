@@ -0,0 +1,242 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # 0~1，取樣的請求才記錄各階段的時間
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"  # 取樣的span另外以一行JSON輸出
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    items = list(key) + list(extra)
+    if len(items) == 0:
+        return ""
+    escaped = ['{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for k, v in items]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append("{}{} {}".format(self.name, _format_labels(key), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}  # 標籤 -> [各區間數量, 總和, 總數]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list[str]:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append("{}_bucket{} {}".format(self.name, _format_labels(key, (("le", str(bound)),)),
+                                                         cumulative))
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(key, (("le", "+Inf"),)), count))
+                lines.append("{}_sum{} {}".format(self.name, _format_labels(key), total))
+                lines.append("{}_count{} {}".format(self.name, _format_labels(key), count))
+        return lines
+
+
+class Gauge:
+    """以函式在輸出時取值，函式回傳數值或 {標籤dict的tuple: 數值}"""
+
+    def __init__(self, name: str, help_text: str, func):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def render(self) -> list[str]:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} gauge".format(self.name)]
+        try:
+            values = self.func()
+        except Exception as e:
+            print("[metrics]: {} {}".format(self.name, e))
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            lines.append("{}{} {}".format(self.name, _format_labels(_label_key(dict(key))), float(value)))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, func) -> Gauge:
+        with self._lock:
+            metric = self._metrics[name] = Gauge(name, help_text, func)  # 重新註冊時以新的函式取代
+            return metric
+
+    def render(self) -> str:
+        """Prometheus文字格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.histogram("lawchat_stage_seconds", "各階段耗時(秒)")
+stage_tokens = registry.counter("lawchat_stage_tokens_total", "各階段的估計token數")
+stage_errors = registry.counter("lawchat_stage_errors_total", "各階段發生的例外數")
+requests_total = registry.counter("lawchat_requests_total", "請求數")
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("lawchat_trace", default=None)
+
+
+class Trace:
+    """一個請求的trace id及是否取樣，其中所有span沿用同一個決定"""
+    __slots__ = ("trace_id", "sampled")
+
+    def __init__(self, sampled: bool):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.sampled = sampled
+
+
+def _sample() -> bool:
+    return TRACE_SAMPLE_RATE >= 1 or random.random() < TRACE_SAMPLE_RATE
+
+
+class Span:
+    __slots__ = ("stage", "attrs")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.attrs = {}
+
+    def set(self, **attrs):
+        """記錄屬性，prompt_tokens、response_tokens會累加到lawchat_stage_tokens_total"""
+        self.attrs.update(attrs)
+
+
+class _NoopSpan(Span):
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan("")
+
+
+def new_trace(name: str) -> Trace:
+    """開始一個請求，依TRACE_SAMPLE_RATE決定是否取樣；lawchat_requests_total不受取樣影響"""
+    requests_total.inc(kind=name)
+    return Trace(_sample())
+
+
+@contextmanager
+def use_trace(current: Trace):
+    """
+    在這個區塊中以current為目前的trace，其中未指定parent的span都屬於它
+    區塊中不可有yield：Gradio在不同的執行緒及context中執行generator的每一步
+    """
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def trace(name: str):
+    """
+    同步函式用：開始新的trace並設為目前的trace，回傳根span
+    generator請以new_trace取得Trace，在yield之間以use_trace及span(parent=)明確傳遞
+    """
+    current = new_trace(name)
+    with use_trace(current), span(name, parent=current) as root:
+        yield root
+
+
+@contextmanager
+def span(stage: str, parent: Trace = None, **attrs):
+    """
+    記錄一個階段的時間及屬性
+    :param parent: 所屬的trace，預設為目前的trace；都沒有時自行依取樣率決定
+    未取樣時不計時，set()也不做任何事
+    """
+    current = parent if parent is not None else _current_trace.get()
+    if current is None:
+        sampled = _sample()
+        trace_id = None
+    else:
+        trace_id, sampled = current.trace_id, current.sampled
+    if not sampled:
+        yield _NOOP
+        return
+    s = Span(stage)
+    s.attrs.update(attrs)
+    start = time.perf_counter()
+    try:
+        yield s
+    except Exception as e:
+        stage_errors.inc(stage=stage, error=type(e).__name__)
+        s.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        for kind in ("prompt_tokens", "response_tokens"):
+            if kind in s.attrs:
+                stage_tokens.inc(s.attrs[kind], stage=stage, kind=kind)
+        if TRACE_LOG:
+            record = {"trace": trace_id, "span": stage, "ms": round(elapsed * 1000, 3)}
+            record.update(s.attrs)
+            print(json.dumps(record, ensure_ascii=False, default=str))
@@ -0,0 +1,362 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from EmbeddingProcessor import FakeEmbedder, GeminiEmbedder
+
+GENERATION_MODEL = 'gemini-1.0-pro'
+EMBEDDING_MODEL = 'models/embedding-001'
+
+
+class ModelResponse:
+    """模型回應：text為完整文字，串流時可逐段迭代(每段也有text)"""
+
+    def __init__(self, chunks: list[str], chunk_delays: list[float] = None):
+        self.chunks = chunks
+        self.chunk_delays = chunk_delays
+        self.text = "".join(chunks)
+
+    def __iter__(self):
+        for i, chunk in enumerate(self.chunks):
+            if self.chunk_delays is not None:
+                time.sleep(self.chunk_delays[i])
+            yield ModelResponse([chunk])
+
+
+class ChatPart:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class ChatMessage:
+    """與Gemini的Content相同的讀取方式：message.role、message.parts[0].text"""
+
+    def __init__(self, role: str, text: str):
+        self.role = role
+        self.parts = [ChatPart(text)]
+
+
+class ModelProvider:
+    """
+    模型後端介面：生成、對話、嵌入及token計數
+    對話物件需提供 send_message(prompt, temperature, stream) 及可讀寫的 history
+    """
+    name = "base"
+    generation_model = GENERATION_MODEL
+    embedding_model = EMBEDDING_MODEL
+
+    def generate(self, prompt: str, temperature: float, stream: bool = False):
+        raise NotImplementedError
+
+    def start_chat(self, history: list = None):
+        raise NotImplementedError
+
+    def message(self, role: str, text: str):
+        """建立可放進對話history的訊息(role為user或model)"""
+        return ChatMessage(role, text)
+
+    def embed(self, texts: list[str], task_type: str = "retrieval_query", titles: list[str] = None
+              ) -> list[list[float]]:
+        raise NotImplementedError
+
+    def count_tokens(self, text: str) -> int:
+        raise NotImplementedError
+
+
+class GeminiChat:
+    def __init__(self, chat):
+        self._chat = chat
+
+    @property
+    def history(self):
+        return self._chat.history
+
+    @history.setter
+    def history(self, value):
+        self._chat.history = value
+
+    def send_message(self, prompt: str, temperature: float, stream: bool = False):
+        import google.generativeai as genai
+        response = self._chat.send_message(prompt,
+                                           generation_config=genai.types.GenerationConfig(temperature=temperature),
+                                           stream=stream)
+        return response
+
+
+class GeminiProvider(ModelProvider):
+    """Google Gemini (google-generativeai)"""
+    name = "gemini"
+
+    def __init__(self, api_key: str = None, generation_model: str = GENERATION_MODEL,
+                 embedding_model: str = EMBEDDING_MODEL):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key if api_key is not None else os.getenv('GOOGLE_API_KEY'))
+        self.generation_model = generation_model
+        self.embedding_model = embedding_model
+        self._model = genai.GenerativeModel(generation_model)
+
+    def generate(self, prompt: str, temperature: float, stream: bool = False):
+        import google.generativeai as genai
+        return self._model.generate_content(prompt,
+                                            generation_config=genai.types.GenerationConfig(temperature=temperature),
+                                            stream=stream)
+
+    def start_chat(self, history: list = None):
+        return GeminiChat(self._model.start_chat(history=history or []))
+
+    def message(self, role: str, text: str):
+        return {"role": role, "parts": [text]}
+
+    def embed(self, texts: list[str], task_type: str = "retrieval_query", titles: list[str] = None
+              ) -> list[list[float]]:
+        if titles is not None:  # embed_content的title為整批共用，各自帶標題時改用batchEmbedContents
+            return GeminiEmbedder(self.embedding_model, task_type).embed_batch(texts, titles)
+        import google.generativeai as genai
+        return genai.embed_content(model=self.embedding_model, content=texts, task_type=task_type)["embedding"]
+
+    def count_tokens(self, text: str) -> int:
+        return self._model.count_tokens(text).total_tokens
+
+
+class LatencyModel:
+    """
+    假模型的延遲分布(秒)
+    :param kind: "constant"(value)、"uniform"(low, high)、"normal"(mean, stddev)、"lognormal"(median, sigma)
+    """
+
+    def __init__(self, kind: str = "constant", **params):
+        self.kind = kind
+        self.params = params
+
+    def sample(self, rng: random.Random) -> float:
+        p = self.params
+        if self.kind == "constant":
+            value = p.get("value", 0.0)
+        elif self.kind == "uniform":
+            value = rng.uniform(p.get("low", 0.0), p.get("high", 0.0))
+        elif self.kind == "normal":
+            value = rng.gauss(p.get("mean", 0.0), p.get("stddev", 0.0))
+        elif self.kind == "lognormal":
+            value = rng.lognormvariate(np.log(max(p.get("median", 0.0), 1e-9)), p.get("sigma", 0.0))
+        else:
+            raise ValueError("未知的延遲分布: " + self.kind)
+        return max(0.0, value)
+
+
+def _default_fake_responder(prompt: str) -> str:
+    if "只輸出JSON" in prompt:
+        return '{"civil": true, "articles": [], "chapters": ["第一編 總則"]}'
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+    return "這是模擬的回答({})。因法律條文僅參考民法，可能有所謬誤，請斟酌參考。".format(digest)
+
+
+class FakeChat:
+    def __init__(self, provider: "FakeProvider", history: list = None):
+        self._provider = provider
+        self.history = list(history or [])
+
+    def send_message(self, prompt: str, temperature: float, stream: bool = False):
+        response = self._provider._respond(prompt, stream)
+        self.history.append(ChatMessage("user", prompt))
+        self.history.append(ChatMessage("model", response.text))
+        return response
+
+
+class FakeProvider(ModelProvider):
+    """
+    本地的確定性假模型，用於壓力測試及分析檢索與提示組裝的開銷
+    :param responder: 輸入提示回傳回答文字的函式
+    :param first_token_latency: 第一段回應前的延遲分布
+    :param chunk_latency: 串流時每段之間的延遲分布
+    :param embed_latency: 每次嵌入請求的延遲分布
+    :param chunk_size: 串流時每段的字數
+    """
+    name = "fake"
+    generation_model = "fake-generation"
+    embedding_model = "fake-embedding"
+
+    def __init__(self, responder=None, first_token_latency: LatencyModel = None, chunk_latency: LatencyModel = None,
+                 embed_latency: LatencyModel = None, chunk_size: int = 16, dim: int = 768, seed: int = 0):
+        self.responder = responder if responder is not None else _default_fake_responder
+        self.first_token_latency = first_token_latency or LatencyModel()
+        self.chunk_latency = chunk_latency or LatencyModel()
+        self.embed_latency = embed_latency or LatencyModel()
+        self.chunk_size = chunk_size
+        self._embedder = FakeEmbedder(dim, self.embedding_model)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _sample(self, latency: LatencyModel) -> float:
+        with self._lock:
+            return latency.sample(self._rng)
+
+    def _respond(self, prompt: str, stream: bool) -> ModelResponse:
+        text = self.responder(prompt)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or [""]
+        first = self._sample(self.first_token_latency)
+        if not stream:
+            time.sleep(first + sum(self._sample(self.chunk_latency) for _ in chunks[1:]))
+            return ModelResponse(chunks)
+        delays = [first] + [self._sample(self.chunk_latency) for _ in chunks[1:]]
+        return ModelResponse(chunks, delays)
+
+    def generate(self, prompt: str, temperature: float, stream: bool = False):
+        return self._respond(prompt, stream)
+
+    def start_chat(self, history: list = None):
+        return FakeChat(self, history)
+
+    def embed(self, texts: list[str], task_type: str = "retrieval_query", titles: list[str] = None
+              ) -> list[list[float]]:
+        time.sleep(self._sample(self.embed_latency))
+        return self._embedder.embed_batch(texts, titles)
+
+    def count_tokens(self, text: str) -> int:
+        return len(text)
+
+
+class ReplayMissError(KeyError):
+    """重播模式下找不到對應的錄製紀錄"""
+
+
+class RecordReplayChat:
+    def __init__(self, provider: "RecordReplayProvider", history: list = None):
+        self._provider = provider
+        self._inner = provider.inner.start_chat(history) if provider.mode == "record" else None
+        self._history = list(history or [])
+
+    @property
+    def history(self):
+        return self._inner.history if self._inner is not None else self._history
+
+    @history.setter
+    def history(self, value):
+        if self._inner is not None:
+            self._inner.history = value
+        else:
+            self._history = list(value)
+
+    def send_message(self, prompt: str, temperature: float, stream: bool = False):
+        context = [[m.role, m.parts[0].text] for m in self.history]
+        key = self._provider._key("chat", context, prompt, temperature)
+
+        def call():
+            return self._inner.send_message(prompt, temperature, stream)
+        response = self._provider._text_call(key, call, stream)
+        if self._inner is None:
+            self._history.append(ChatMessage("user", prompt))
+            self._history.append(ChatMessage("model", response.text))
+        return response
+
+
+class RecordReplayProvider(ModelProvider):
+    """
+    錄製/重播：record模式呼叫inner並將回應寫入path(JSONL)，replay模式只從錄製檔回應，不連線
+    鍵為方法名稱及參數的雜湊，串流回應會保留原本的分段
+    """
+    name = "record_replay"
+
+    def __init__(self, path: str, mode: str = "replay", inner: ModelProvider = None,
+                 generation_model: str = GENERATION_MODEL, embedding_model: str = EMBEDDING_MODEL):
+        if mode not in ("record", "replay"):
+            raise ValueError("mode 必須是 record 或 replay")
+        if mode == "record" and inner is None:
+            raise ValueError("record 模式需要 inner provider")
+        self.path = path
+        self.mode = mode
+        self.inner = inner
+        # 模型名稱是鍵的一部分，重播時需與錄製時相同
+        self.generation_model = inner.generation_model if inner is not None else generation_model
+        self.embedding_model = inner.embedding_model if inner is not None else embedding_model
+        self._records: dict[str, object] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._records[record["key"]] = record["value"]
+
+    def _key(self, *args) -> str:
+        return hashlib.sha256(json.dumps(args, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str, call):
+        with self._lock:
+            if key in self._records:
+                return self._records[key]
+        if self.mode == "replay":
+            raise ReplayMissError(key)
+        value = call()
+        with self._lock:
+            self._records[key] = value
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, 'a', encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "value": value}, ensure_ascii=False) + "\n")
+        return value
+
+    def _text_call(self, key: str, call, stream: bool) -> ModelResponse:
+        def record():
+            response = call()
+            return [chunk.text for chunk in response] if stream else [response.text]
+        return ModelResponse(self._lookup(key, record))
+
+    def generate(self, prompt: str, temperature: float, stream: bool = False):
+        key = self._key("generate", self.generation_model, prompt, temperature)
+        return self._text_call(key, lambda: self.inner.generate(prompt, temperature, stream), stream)
+
+    def start_chat(self, history: list = None):
+        return RecordReplayChat(self, history)
+
+    def message(self, role: str, text: str):
+        return self.inner.message(role, text) if self.mode == "record" else ChatMessage(role, text)
+
+    def embed(self, texts: list[str], task_type: str = "retrieval_query", titles: list[str] = None
+              ) -> list[list[float]]:
+        key = self._key("embed", self.embedding_model, texts, task_type, titles)
+        return self._lookup(key, lambda: [[float(x) for x in e] for e in self.inner.embed(texts, task_type, titles)])
+
+    def count_tokens(self, text: str) -> int:
+        key = self._key("count_tokens", self.generation_model, text)
+        return self._lookup(key, lambda: int(self.inner.count_tokens(text)))
+
+
+def create_provider(name: str = None) -> ModelProvider:
+    """
+    依名稱(或環境變數MODEL_PROVIDER)建立模型後端：gemini、fake、record、replay
+    record/replay 的錄製檔路徑為環境變數MODEL_RECORD_PATH
+    """
+    name = name or os.getenv("MODEL_PROVIDER", "gemini")
+    if name == "gemini":
+        return GeminiProvider()
+    if name == "fake":
+        latency = LatencyModel("lognormal", median=float(os.getenv("FAKE_MODEL_LATENCY", "0")), sigma=0.5)
+        return FakeProvider(first_token_latency=latency)
+    record_path = os.getenv("MODEL_RECORD_PATH", "recordings/model_responses.jsonl")
+    if name == "record":
+        return RecordReplayProvider(record_path, "record", GeminiProvider())
+    if name == "replay":
+        return RecordReplayProvider(record_path, "replay")
+    raise ValueError("未知的模型後端: " + name)
+
+
+class ProviderEmbedder:
+    """讓ModelProvider可用於EmbeddingProcessor.ingest_embeddings的嵌入器介面"""
+
+    def __init__(self, provider: ModelProvider, task_type: str = "retrieval_document", client=None):
+        self.provider = provider
+        self.model = provider.embedding_model
+        self.task_type = task_type
+        self.client = client
+
+    def embed_batch(self, contents: list[str], titles: list[str] = None) -> list[list[float]]:
+        if self.client is None:
+            return self.provider.embed(contents, self.task_type, titles)
+        tokens = sum(len(c) for c in contents)
+        return self.client.call(self.provider.embed, contents, self.task_type, titles, tokens=tokens)
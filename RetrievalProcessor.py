@@ -0,0 +1,431 @@
+import json
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Iterator, Union
+
+import numpy as np
+
+from LawDataProcessor import DATA_DIR, Article, LawData
+
+QUANTIZATION_MODES = ("int8", "binary")
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_CHUNK_ROWS = 8192  # 分段計算，暫存的float32陣列不超過這個列數
+_SCORE_CHUNK_ROWS = 256  # int8轉float32計分時每段的列數，暫存區留在CPU快取內才不會比float32慢
+
+
+class RetrievalResult:
+    """檢索結果，條文與點積值依相關度由高到低排列"""
+    __slots__ = ("articles", "scores")
+
+    def __init__(self, articles: list[Article], scores: np.ndarray):
+        self.articles = articles
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.articles)
+
+    def __iter__(self) -> Iterator[tuple[Article, float]]:
+        return zip(self.articles, self.scores.tolist())
+
+    def titles(self) -> list[str]:
+        return [a.get_article_title(a.article_law_name) for a in self.articles]
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2正規化每一列，零向量維持為零"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+def select_top_k(scores: np.ndarray, top_k: int, threshold: float = None) -> np.ndarray:
+    """
+    以argpartition取出分數最高的top_k筆(先套用閾值)，回傳依分數排序的索引
+    """
+    if threshold is not None:
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(scores))
+    if top_k is not None and len(candidates) > top_k:
+        part = np.argpartition(scores[candidates], -top_k)[-top_k:]
+        candidates = candidates[part]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class ArticleIndex:
+    """
+    條文嵌入的檢索索引，保存預先L2正規化的嵌入矩陣
+    單一查詢為一次矩陣向量乘法，批次查詢為一次矩陣乘法
+    """
+
+    def __init__(self, articles: list[Article], matrix: np.ndarray, normalized: bool = False):
+        self.articles = articles
+        self.matrix = matrix if normalized else normalize_rows(matrix)
+
+    def __len__(self):
+        return len(self.articles)
+
+    @classmethod
+    def from_laws(cls, laws: list[LawData]) -> "ArticleIndex":
+        """由一或多部法律建立索引，沒有嵌入向量的條文不列入"""
+        articles = []
+        matrices = []
+        for law in laws:
+            if law is None:
+                continue
+            matrix = law.embedding_matrix
+            if matrix is not None:
+                articles.extend(law.law_articles)
+                matrices.append(matrix)
+                continue
+            embedded = [a for a in law.law_articles if a.article_embedding is not None]
+            if len(embedded) != 0:
+                articles.extend(embedded)
+                matrices.append(np.stack([a.article_embedding for a in embedded]))
+        if len(matrices) == 0:
+            return cls([], np.zeros((0, 0), dtype=np.float32), normalized=True)
+        return cls(articles, np.concatenate(matrices, axis=0))
+
+    @classmethod
+    def merge(cls, indexes: list["ArticleIndex"]) -> "ArticleIndex":
+        """合併多個已正規化的索引，不重新計算正規化"""
+        indexes = [i for i in indexes if len(i) != 0]
+        if len(indexes) == 0:
+            return cls([], np.zeros((0, 0), dtype=np.float32), normalized=True)
+        if len(indexes) == 1:
+            return indexes[0]
+        articles = []
+        for i in indexes:
+            articles.extend(i.articles)
+        return cls(articles, np.concatenate([i.matrix for i in indexes], axis=0), normalized=True)
+
+    def scores(self, query_embedding) -> np.ndarray:
+        query = normalize_rows(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1))[0]
+        return self.matrix @ query
+
+    def search(self, query_embedding, top_k: int = 100, threshold: float = None) -> RetrievalResult:
+        """
+        :param query_embedding: 查詢的嵌入向量
+        :param top_k: 最多回傳幾條
+        :param threshold: 相關度(餘弦相似度)最低應高於此值，None表示不過濾
+        """
+        if len(self.articles) == 0:
+            return RetrievalResult([], np.zeros(0, dtype=np.float32))
+        scores = self.scores(query_embedding)
+        idx = select_top_k(scores, top_k, threshold)
+        return RetrievalResult([self.articles[i] for i in idx], scores[idx])
+
+    def search_batch(self, query_embeddings, top_k: int = 100, threshold: float = None) -> list[RetrievalResult]:
+        """批次查詢：以一次矩陣乘法計算所有查詢的分數"""
+        queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1))
+        if len(self.articles) == 0:
+            return [RetrievalResult([], np.zeros(0, dtype=np.float32)) for _ in range(len(queries))]
+        all_scores = queries @ self.matrix.T
+        results = []
+        for scores in all_scores:
+            idx = select_top_k(scores, top_k, threshold)
+            results.append(RetrievalResult([self.articles[i] for i in idx], scores[idx]))
+        return results
+
+
+def quantize_int8(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    每列先L2正規化，再以該列的最大絕對值/127為縮放係數量化成int8
+    :return: (int8矩陣, 每列的float32縮放係數)，codes[i] * scales[i] 近似正規化後的第i列
+    """
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), _CHUNK_ROWS):
+        chunk = normalize_rows(matrix[start:start + _CHUNK_ROWS])
+        scale = np.abs(chunk).max(axis=1) / 127
+        scale[scale == 0] = 1.0
+        codes[start:start + len(chunk)] = np.rint(chunk / scale[:, None])
+        scales[start:start + len(chunk)] = scale
+    return codes, scales
+
+
+def pack_sign_bits(matrix: np.ndarray) -> np.ndarray:
+    """每個維度只保留正負號，每8維壓成一個位元組"""
+    return np.packbits(np.asarray(matrix) > 0, axis=-1)
+
+
+def get_quantized_path(law_name: str, mode: str, data_dir: str = DATA_DIR) -> str:
+    return os.path.join(data_dir, "{}.{}.npz".format(law_name, mode))
+
+
+class QuantizedIndex:
+    """
+    量化嵌入的兩階段檢索：先以量化矩陣計算近似分數挑出 top_k * rescore_factor 個候選，再以float32重新計分
+    int8(每列一個縮放係數)約為float32的1/4，符號位元約為1/32
+    float32矩陣不必在記憶體中：由二進位檔載入的法律是mmap，重新計分時只讀取候選的列
+    """
+
+    def __init__(self, articles: list[Article], codes: np.ndarray, scales: np.ndarray, sources: list[np.ndarray],
+                 mode: str = "int8", rescore_factor: int = 4):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError("不支援的量化方式: {}".format(mode))
+        self.articles = articles
+        self.codes = codes
+        self.scales = scales
+        self.sources = sources  # 原始(未正規化)的float32矩陣(或_ArticleEmbeddings)，依序對應articles
+        self.offsets = np.cumsum([0] + [len(m) for m in sources])
+        self.mode = mode
+        self.rescore_factor = rescore_factor
+
+    def __len__(self):
+        return len(self.articles)
+
+    @property
+    def nbytes(self) -> int:
+        """量化矩陣佔用的記憶體"""
+        return self.codes.nbytes + self.scales.nbytes
+
+    @classmethod
+    def from_laws(cls, laws: list[LawData], mode: str = "int8", rescore_factor: int = 4,
+                  data_dir: str = DATA_DIR, save: bool = True) -> "QuantizedIndex":
+        """由一或多部法律建立索引，由二進位檔載入的法律會讀寫 {法律名稱}.{mode}.npz，沒有嵌入向量的條文不列入"""
+        return cls.merge([_quantize_law(law, mode, rescore_factor, data_dir, save) for law in laws
+                          if law is not None], mode, rescore_factor)
+
+    @classmethod
+    def merge(cls, indexes: list["QuantizedIndex"], mode: str = "int8", rescore_factor: int = 4) -> "QuantizedIndex":
+        indexes = [i for i in indexes if len(i) != 0]
+        if len(indexes) == 1:
+            return indexes[0]
+        width = 0 if len(indexes) == 0 else indexes[0].codes.shape[1]
+        codes_dtype = np.int8 if mode == "int8" else np.uint8
+        articles = []
+        sources = []
+        for i in indexes:
+            articles.extend(i.articles)
+            sources.extend(i.sources)
+        if len(indexes) == 0:
+            return cls([], np.zeros((0, width), dtype=codes_dtype), np.zeros(0, dtype=np.float32), [], mode,
+                       rescore_factor)
+        return cls(articles, np.concatenate([i.codes for i in indexes], axis=0),
+                   np.concatenate([i.scales for i in indexes]), sources, mode, rescore_factor)
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        """第一階段：int8為近似的餘弦相似度，符號位元為相同正負號的維度數減去不同的維度數"""
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        if self.mode == "binary":
+            codes = self.codes
+            bits = pack_sign_bits(query)
+            dim = codes.shape[1] * 8
+            popcount = getattr(np, "bitwise_count", None)  # numpy 2.0以上
+            if popcount is not None and codes.shape[1] % 8 == 0 and codes.flags.c_contiguous:
+                codes, bits = codes.view(np.uint64), bits.view(np.uint64)  # 一次計算64個維度
+            else:
+                popcount = _POPCOUNT.__getitem__
+            for start in range(0, len(codes), _CHUNK_ROWS):
+                chunk = codes[start:start + _CHUNK_ROWS]
+                distance = popcount(chunk ^ bits).sum(axis=1, dtype=np.int32)
+                scores[start:start + len(chunk)] = dim - 2 * distance
+            return scores
+        buffer = np.empty((min(_SCORE_CHUNK_ROWS, len(self.codes)), self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.codes), _SCORE_CHUNK_ROWS):
+            chunk = self.codes[start:start + _SCORE_CHUNK_ROWS]
+            block = buffer[:len(chunk)]
+            np.copyto(block, chunk, casting="unsafe")
+            np.matmul(block, query, out=scores[start:start + len(chunk)])
+        scores *= self.scales
+        return scores
+
+    def exact_scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """第二階段：由float32矩陣讀取指定的列(需已排序)計算餘弦相似度"""
+        vectors = []
+        for source, start, end in zip(self.sources, self.offsets[:-1], self.offsets[1:]):
+            lo, hi = np.searchsorted(rows, [start, end])
+            if hi > lo:
+                vectors.append(np.asarray(source[rows[lo:hi] - start], dtype=np.float32))
+        if len(vectors) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return normalize_rows(np.concatenate(vectors, axis=0)) @ query
+
+    def search(self, query_embedding, top_k: int = 100, threshold: float = None,
+               rescore_factor: int = None) -> RetrievalResult:
+        """
+        :param top_k: 最多回傳幾條，None時全部以float32計分
+        :param threshold: 以float32的餘弦相似度過濾
+        :param rescore_factor: 重新計分的候選數為top_k的幾倍，越大召回率越高、越慢
+        """
+        if len(self.articles) == 0:
+            return RetrievalResult([], np.zeros(0, dtype=np.float32))
+        query = normalize_rows(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1))[0]
+        factor = self.rescore_factor if rescore_factor is None else rescore_factor
+        if top_k is None or top_k * factor >= len(self.articles):
+            candidates = np.arange(len(self.articles))
+        else:
+            candidates = np.sort(select_top_k(self.approximate_scores(query), top_k * factor))
+        scores = self.exact_scores(candidates, query)
+        idx = select_top_k(scores, top_k, threshold)
+        return RetrievalResult([self.articles[i] for i in candidates[idx]], scores[idx])
+
+
+class _ArticleEmbeddings:
+    """沒有mmap矩陣的法律，重新計分時才由條文取出候選的嵌入向量，不另外保存一份float32矩陣"""
+
+    def __init__(self, articles: list[Article]):
+        self.articles = articles
+
+    def __len__(self):
+        return len(self.articles)
+
+    def __getitem__(self, rows: np.ndarray) -> np.ndarray:
+        return np.stack([np.asarray(self.articles[i].article_embedding, dtype=np.float32) for i in rows.tolist()])
+
+
+def _quantize_law(law: LawData, mode: str, rescore_factor: int, data_dir: str, save: bool) -> QuantizedIndex:
+    source_file = law._embedding_file
+    if source_file is not None:
+        articles = law.law_articles
+        matrix = law.embedding_matrix  # mmap
+        source = matrix
+    else:
+        articles = [a for a in law.law_articles if a.article_embedding is not None]
+        if len(articles) == 0:
+            return QuantizedIndex.merge([], mode, rescore_factor)
+        matrix = np.stack([a.article_embedding for a in articles])  # 只在量化時使用
+        source = _ArticleEmbeddings(articles)
+    path = get_quantized_path(law.law_name, mode, data_dir)
+    signature = None
+    if source_file is not None:
+        stat = os.stat(source_file)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        if os.path.exists(path):
+            try:
+                with np.load(path, allow_pickle=False) as data:
+                    meta = json.loads(str(data["meta"]))
+                    if meta["signature"] == signature and len(data["codes"]) == len(articles):
+                        return QuantizedIndex(articles, data["codes"], data["scales"], [source], mode,
+                                              rescore_factor)
+            except (OSError, ValueError, KeyError) as e:
+                print("無法讀取量化嵌入 {}: {}".format(path, e))
+    if mode == "int8":
+        codes, scales = quantize_int8(matrix)
+    else:
+        codes = np.concatenate([pack_sign_bits(matrix[i:i + _CHUNK_ROWS])
+                                for i in range(0, len(matrix), _CHUNK_ROWS)], axis=0)
+        scales = np.zeros(0, dtype=np.float32)
+    if save and signature is not None and os.path.isdir(data_dir):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, codes=codes, scales=scales, meta=np.asarray(json.dumps({"signature": signature})))
+        os.replace(tmp_path, path)
+    return QuantizedIndex(articles, codes, scales, [source], mode, rescore_factor)
+
+
+_index_lock = threading.Lock()
+_law_indexes: "weakref.WeakKeyDictionary[LawData, dict]" = weakref.WeakKeyDictionary()  # 法律 -> {量化方式: 索引}
+_merged_indexes: OrderedDict[tuple, tuple[list, Union[ArticleIndex, QuantizedIndex]]] = OrderedDict()
+_MAX_MERGED_INDEXES = 16
+
+
+def get_law_index(law: LawData, quantization: str = None) -> Union[ArticleIndex, QuantizedIndex]:
+    """
+    取得法律的檢索索引，同一個LawData物件只建立一次(LawRegistry重新載入後會是新物件)
+    :param quantization: None/"none"為float32，"int8"或"binary"為量化嵌入的兩階段檢索
+    """
+    quantization = None if quantization in (None, "none") else quantization
+    with _index_lock:
+        index = _law_indexes.get(law, {}).get(quantization)
+    if index is None:
+        if quantization is None:
+            index = ArticleIndex.from_laws([law])
+        else:
+            index = QuantizedIndex.from_laws([law], quantization)
+        with _index_lock:
+            _law_indexes.setdefault(law, {})[quantization] = index
+    return index
+
+
+def get_laws_index(laws: list[LawData], quantization: str = None) -> Union[ArticleIndex, QuantizedIndex]:
+    """取得多部法律合併後的檢索索引"""
+    quantization = None if quantization in (None, "none") else quantization
+    laws = [law for law in laws if law is not None]
+    if len(laws) == 1:
+        return get_law_index(laws[0], quantization)
+    key = (quantization,) + tuple(id(law) for law in laws)
+    with _index_lock:
+        cached = _merged_indexes.get(key)
+        if cached is not None and all(ref() is law for ref, law in zip(cached[0], laws)):
+            _merged_indexes.move_to_end(key)
+            return cached[1]
+    indexes = [get_law_index(law, quantization) for law in laws]
+    if quantization is None:
+        index = ArticleIndex.merge(indexes)
+    else:
+        index = QuantizedIndex.merge(indexes, quantization)
+    with _index_lock:
+        _merged_indexes[key] = ([weakref.ref(law) for law in laws], index)
+        while len(_merged_indexes) > _MAX_MERGED_INDEXES:
+            _merged_indexes.popitem(last=False)
+    return index
+
+
+def search_laws(query_embedding, laws: Union[LawData, list[LawData]], top_k: int = 100,
+                threshold: float = None, quantization: str = None, rescore_factor: int = 4) -> RetrievalResult:
+    """
+    :param quantization: None為float32精確檢索，"int8"/"binary"先以量化矩陣挑選候選再以float32重新計分
+    :param rescore_factor: 量化檢索時重新計分的候選數為top_k的幾倍
+    """
+    if isinstance(laws, LawData):
+        laws = [laws]
+    index = get_laws_index(laws, quantization)
+    if isinstance(index, QuantizedIndex):
+        return index.search(query_embedding, top_k, threshold, rescore_factor)
+    return index.search(query_embedding, top_k, threshold)
+
+
+_CJK_CHAR = re.compile(r"[⺀-鿿豈-﫿　-〿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估計token數：中日韓字元及全形標點約一字一token，其餘約四個字元一token"""
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def format_article(article: Article) -> str:
+    """條文放進提示時的格式"""
+    return article.article_law_name + article.article_number + " " + article.article_content + "\n"
+
+
+def pack_articles(articles: list[Article], query_embedding, token_budget: int, ranking=None) -> list[Article]:
+    """
+    在token預算內挑選條文：依與問題的嵌入相似度排序，由高到低放入放得下的條文
+    沒有嵌入向量的條文排在最後，輸出維持原本的條文順序
+    :param articles: 候選條文
+    :param query_embedding: 問題的嵌入向量，或回傳嵌入向量的函式(只在超出預算時才呼叫)，None時依原順序放入
+    :param token_budget: 條文可使用的token數
+    :param ranking: 回傳依相關度排序的條文清單的函式(只在超出預算時才呼叫)，指定時取代嵌入相似度，未列入的條文排在最後
+    """
+    articles = [a for a in articles if a is not None]
+    costs = [estimate_tokens(format_article(a)) for a in articles]
+    if sum(costs) <= token_budget:
+        return articles
+    scores = np.full(len(articles), -np.inf, dtype=np.float32)
+    if ranking is not None:
+        rows = {id(a): i for i, a in enumerate(articles)}
+        ranked = [rows[id(a)] for a in ranking() if id(a) in rows]
+        scores[ranked] = -np.arange(len(ranked), dtype=np.float32)
+    else:
+        if callable(query_embedding):
+            query_embedding = query_embedding()
+        if query_embedding is not None:
+            embedded = [i for i, a in enumerate(articles) if a.article_embedding is not None]
+            if len(embedded) != 0:
+                index = ArticleIndex([articles[i] for i in embedded],
+                                     np.stack([articles[i].article_embedding for i in embedded]))
+                scores[embedded] = index.scores(query_embedding)
+    order = np.argsort(-scores, kind="stable")
+    selected = []
+    used = 0
+    for i in order.tolist():
+        if used + costs[i] <= token_budget:
+            selected.append(i)
+            used += costs[i]
+    return [articles[i] for i in sorted(selected)]
@@ -1,6 +1,13 @@
+import time
+
+process_start = time.monotonic()
+
 import homepage
 import chatpage
+import AIProcessor
+import MetricsProcessor
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 import gradio as gr
 import uvicorn
 import dotenv
@@ -10,7 +17,44 @@ hp = homepage.homepage_app()
 cp = chatpage.chatpage_app()
 dotenv.load_dotenv()
 
+startup_budget = float(os.getenv("STARTUP_BUDGET_SECONDS", "5"))  # 由行程啟動到開始服務的時間上限
+startup_seconds = None
+
 app = FastAPI()
+
+
+@app.on_event("startup")
+def on_startup():
+    """伺服器開始服務：記錄啟動時間並在背景預先載入法律"""
+    global startup_seconds
+    startup_seconds = round(time.monotonic() - process_start, 3)
+    if startup_seconds > startup_budget:
+        print("[startup]: {} 秒，超過預算 {} 秒".format(startup_seconds, startup_budget))
+    else:
+        print("[startup]: {} 秒".format(startup_seconds))
+    AIProcessor.start_prewarm()
+
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+def ready():
+    """預先載入完成前或失敗(有錯誤、法律不存在)時回傳503，可作為負載平衡器的readiness檢查"""
+    status = AIProcessor.readiness()
+    status["startup_seconds"] = startup_seconds
+    status["startup_budget"] = startup_budget
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus格式的各階段耗時、token數、快取命中率及模型呼叫狀態"""
+    return PlainTextResponse(MetricsProcessor.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 app = gr.mount_gradio_app(app, hp, path="/home")
 app = gr.mount_gradio_app(app, cp, path="/chat", auth=("admin", "admin"))
 host = os.getenv("SERVER_HOST")
@@ -0,0 +1,324 @@
+"""
+檢索流程的效能測試
+
+    python benchmark.py                                  # 內附的LawData及10k/100k條的合成法律
+    python benchmark.py --sizes 1000000 --repeats 5      # 1M條(索引建立需要數GB記憶體，需明確指定)
+    python benchmark.py --sizes 10000 --repeats 50 --output bench.json
+    python benchmark.py --sizes 10000 --compare bench.json   # 與之前的結果比較
+
+以假模型(FakeProvider)執行，不呼叫Gemini；輸出各操作的延遲百分位數及峰值記憶體(tracemalloc)，
+--output 會寫出JSON(含commit)，可用 --compare 比較不同commit的結果
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("MODEL_PROVIDER", "fake")
+
+import numpy as np
+
+import AIProcessor
+import AnnIndexProcessor
+import ChatHistoryProcessor
+import EmbeddingProcessor
+import LawDataProcessor
+import ModelProviderProcessor
+import RetrievalProcessor
+from ChatSessionProcessor import ChatSession
+from LawDataProcessor import DATA_DIR, LawData
+
+DEFAULT_SIZES = [10000, 100000]  # 1M條需以--sizes明確指定
+CHAPTER_SHAPE = (5, 10, 10)  # 合成法律的 編、每編的章、每章的節
+
+
+def measure(func, repeats: int, setup=None) -> dict:
+    """
+    執行func repeats次，回傳延遲(毫秒)百分位數及單次呼叫的峰值記憶體(MB)
+    tracemalloc會拖慢執行，峰值記憶體另外執行一次量測
+    :param setup: 每次執行前呼叫，回傳值作為func的參數(不計入時間)
+    """
+    def run_once():
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func() if setup is None else func(arg)
+        return (time.perf_counter() - start) * 1000
+
+    latencies = sorted(run_once() for _ in range(repeats))
+    tracemalloc.start()
+    run_once()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))]
+    return {"repeats": repeats,
+            "mean_ms": statistics.fmean(latencies),
+            "p50_ms": pct(50),
+            "p90_ms": pct(90),
+            "p99_ms": pct(99),
+            "max_ms": latencies[-1],
+            "peak_mb": peak / (1024 * 1024)}
+
+
+def write_synthetic_store(data_dir: str, law_name: str, n_articles: int, dim: int, seed: int = 0):
+    """
+    以二進位格式寫出n_articles條的合成法律(含編章節標題)
+    嵌入矩陣分段寫入mmap，不需一次放進記憶體
+    """
+    rng = np.random.default_rng(seed)
+    n_books, n_chapters, n_sections = CHAPTER_SHAPE
+    n_groups = n_books * n_chapters * n_sections
+    per_group = max(1, n_articles // n_groups)
+    articles = []
+    num = 0
+    for b in range(n_books):
+        articles.append({"ArticleNumber": "", "ArticleContent": "第 {} 編 編{}".format(b + 1, b + 1)})
+        for c in range(n_chapters):
+            articles.append({"ArticleNumber": "", "ArticleContent": "第 {} 章 章{}".format(c + 1, c + 1)})
+            for s in range(n_sections):
+                articles.append({"ArticleNumber": "", "ArticleContent": "第 {} 節 節{}".format(s + 1, s + 1)})
+                for _ in range(per_group):
+                    if num >= n_articles:
+                        break
+                    num += 1
+                    number = "第 {} 條".format(num) if num % 10 != 0 else "第 {}-1 條".format(num - 1)
+                    articles.append({"ArticleNumber": number,
+                                     "ArticleContent": "合成條文{}：當事人之權利義務，依本法之規定。".format(num)})
+    meta = {"LawName": law_name, "LawLevel": "法律", "LawModifiedDate": "20240101", "LawEffectiveDate": "",
+            "EmbeddingDim": dim, "LawArticles": articles}
+    meta_path, npy_path, _ = LawDataProcessor.get_data_paths(law_name, data_dir)
+    with open(meta_path, 'w', encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    matrix = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.float32, shape=(len(articles), dim))
+    for i in range(0, len(articles), 65536):
+        chunk = rng.standard_normal((min(65536, len(articles) - i), dim)).astype(np.float32)
+        matrix[i:i + len(chunk)] = chunk / np.linalg.norm(chunk, axis=1, keepdims=True)
+    matrix.flush()
+    del matrix
+
+
+def load_binary(data_dir: str, law_name: str) -> LawData:
+    meta_path, npy_path, _ = LawDataProcessor.get_data_paths(law_name, data_dir)
+    law = LawData()
+    law.get_law_binary_data(meta_path, npy_path)
+    return law
+
+
+def bench_law(law_name: str, data_dir: str, repeats: int, heavy_repeats: int, rng: random.Random,
+              legacy_json: bool = False) -> dict:
+    results = {}
+    law = load_binary(data_dir, law_name)
+    results["load_data"] = measure(lambda: load_binary(data_dir, law_name), heavy_repeats)
+    _, _, json_path = LawDataProcessor.get_data_paths(law_name, data_dir)
+    if legacy_json and os.path.exists(json_path):
+        def load_json():
+            with open(json_path, 'r', encoding="utf-8") as f:
+                LawData().get_law_json_data(f, law_name)
+        results["load_data_legacy_json"] = measure(load_json, heavy_repeats)
+
+    save_dir = tempfile.mkdtemp(prefix="bench_save_")
+    try:
+        results["save_data"] = measure(lambda: LawDataProcessor.save_data(law, save_dir), heavy_repeats)
+    finally:
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+    dim = law.embedding_matrix.shape[1] if law.embedding_matrix is not None else 768
+    AIProcessor.provider = ModelProviderProcessor.FakeProvider(dim=dim)
+    AIProcessor.embedding_cache = EmbeddingProcessor.EmbeddingCache(path=None)
+    queries = ["問題{}".format(i) for i in range(8)]
+    AIProcessor.embed_queries(queries)  # 預先放進快取，只量測檢索本身
+    AIProcessor.get_pd_dataframe_with_dot_products(queries[0], law)  # 建立索引
+    results["get_pd_dataframe_with_dot_products"] = measure(
+        lambda q: AIProcessor.get_pd_dataframe_with_dot_products(q, law), repeats, lambda: rng.choice(queries))
+    results["search_related_articles"] = measure(
+        lambda q: AIProcessor.search_related_articles(q, [law], threshold=0.0), repeats, lambda: rng.choice(queries))
+
+    law.get_table_of_articles()  # 建立章節索引
+    paths = sorted(law._chapter_ranges)
+    if len(paths) != 0:
+        results["get_articles_by_chapters"] = measure(
+            lambda chs: law.get_articles_by_chapters(chs), repeats,
+            lambda: [list(p) for p in rng.sample(paths, min(3, len(paths)))])
+    results["get_table_of_articles"] = measure(law.get_table_of_articles, repeats)
+    numbers = [a.article_number for a in law.law_articles if a.article_number != ""]
+    results["get_article_by_num"] = measure(lambda n: law.get_article_by_num(n), repeats,
+                                            lambda: "N" + LawDataProcessor.normalize_article_number(rng.choice(numbers)))
+    results["articles"] = len(law.law_articles)
+    return results
+
+
+def bench_ann(law: LawData, repeats: int, rng: random.Random, top_k: int = 10) -> dict:
+    """ANN索引的建立時間、查詢延遲及各nprobe的召回率(以精確搜尋為準)"""
+    numbers, vectors = AnnIndexProcessor.law_vectors(law)
+    start = time.perf_counter()
+    index = AnnIndexProcessor.IVFIndex.train(vectors)
+    index.add(law.law_name, numbers, vectors)
+    results = {"build_s": time.perf_counter() - start, "n_lists": index.n_lists}
+    noise = np.random.default_rng(0).standard_normal((repeats, vectors.shape[1])).astype(np.float32) * 0.02
+    queries = np.asarray(vectors[[rng.randrange(len(vectors)) for _ in range(repeats)]]) + noise
+    results["search"] = measure(lambda q: index.search(q, top_k), repeats, lambda: queries[rng.randrange(repeats)])
+    results["exact_search"] = measure(lambda q: index.exact_search(q, top_k), repeats,
+                                      lambda: queries[rng.randrange(repeats)])
+    results["recall_at_{}".format(top_k)] = index.measure_recall(queries, top_k)
+    return results
+
+
+def bench_quantization(laws: list[LawData], repeats: int, rng: random.Random, top_k: int = 10,
+                       rescore_factors: list[int] = None) -> dict:
+    """量化嵌入兩階段檢索的召回率(以float32精確搜尋為準)、延遲及每個向量佔用的位元組"""
+    exact_index = RetrievalProcessor.ArticleIndex.from_laws(laws)
+    results = {"articles": len(exact_index)}
+    if len(exact_index) == 0:
+        return results
+    matrix = exact_index.matrix
+    noise = np.random.default_rng(0).standard_normal((repeats, matrix.shape[1])).astype(np.float32) * 0.02
+    queries = matrix[[rng.randrange(len(matrix)) for _ in range(repeats)]] + noise
+    truth = [{id(a) for a in exact_index.search(q, top_k).articles} for q in queries]
+    report = [{"mode": "float32", "rescore": 0, "recall": 1.0, "bytes_per_vector": matrix.shape[1] * 4,
+               "latency_ms": _mean_latency_ms(lambda q: exact_index.search(q, top_k), queries)}]
+    for mode in RetrievalProcessor.QUANTIZATION_MODES:
+        index = RetrievalProcessor.QuantizedIndex.from_laws(laws, mode, save=False)
+        for factor in rescore_factors or [1, 2, 4, 8]:
+            hits = sum(len(t & {id(a) for a in index.search(q, top_k, rescore_factor=factor).articles})
+                       for t, q in zip(truth, queries))
+            report.append({"mode": mode, "rescore": factor,
+                           "recall": hits / max(1, sum(len(t) for t in truth)),
+                           "bytes_per_vector": index.nbytes / len(index),
+                           "latency_ms": _mean_latency_ms(lambda q: index.search(q, top_k, rescore_factor=factor),
+                                                          queries)})
+    results["recall_at_{}".format(top_k)] = report
+    return results
+
+
+def _mean_latency_ms(func, queries) -> float:
+    start = time.perf_counter()
+    for q in queries:
+        func(q)
+    return (time.perf_counter() - start) / max(1, len(queries)) * 1000
+
+
+def bench_chat_history(turns_list: list[int], repeats: int) -> dict:
+    """量測gemini_chat每回合結束時更新對話紀錄的時間"""
+    results = {}
+    provider = ModelProviderProcessor.FakeProvider()
+    history_dir = tempfile.mkdtemp(prefix="bench_history_")
+    AIProcessor.history_store = ChatHistoryProcessor.ChatHistoryStore(history_dir)
+    try:
+        for turns in turns_list:
+            chat = provider.start_chat()
+            chat.send_message("系統資訊" * 2000, 0.9)
+            for i in range(turns):
+                chat.send_message("問題{}".format(i), 0.8)
+            pairs = [(chat.history[i].parts[0].text, chat.history[i + 1].parts[0].text)
+                     for i in range(2, len(chat.history), 2)]
+
+            def setup():
+                session = ChatSession("bench:{}".format(turns))
+                session.chat = provider.start_chat(list(chat.history))
+                session.history = list(pairs)
+                session.related_articles = []
+                session.started = True
+                session.log_session = "bench"
+                AIProcessor._trim_window(session)  # 實際對話每回合都會修剪，從穩定狀態開始量測
+                return session
+            results["turns_{}".format(turns)] = measure(
+                lambda session: AIProcessor._finish_turn(session, "問題", "回答"), repeats, setup)
+    finally:
+        shutil.rmtree(history_dir, ignore_errors=True)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_results(results: dict, baseline: dict = None):
+    for group, ops in results["benchmarks"].items():
+        print("== " + group)
+        for op, r in ops.items():
+            if isinstance(r, list):  # 召回率報告
+                for row in r:
+                    if "nprobe" in row:
+                        print("  {:<38} nprobe {:>4}  recall {:.3f}  {:>10.3f} ms".format(
+                            op, row["nprobe"], row["recall"], row["latency_ms"]))
+                    else:
+                        print("  {:<38} {:<7} rescore x{:<3} recall {:.3f}  {:>10.3f} ms  {:>8.1f} B/vector".format(
+                            op, row["mode"], row["rescore"], row["recall"], row["latency_ms"],
+                            row["bytes_per_vector"]))
+            if not isinstance(r, dict):
+                continue
+            line = "  {:<38} p50 {:>10.3f} ms  p90 {:>10.3f} ms  p99 {:>10.3f} ms  peak {:>9.2f} MB".format(
+                op, r["p50_ms"], r["p90_ms"], r["p99_ms"], r["peak_mb"])
+            old = (baseline or {}).get("benchmarks", {}).get(group, {}).get(op)
+            if isinstance(old, dict) and old["p50_ms"] > 0:
+                line += "  p50 x{:.2f} vs {}".format(r["p50_ms"] / old["p50_ms"], baseline.get("commit", "baseline"))
+            print(line)
+    print("max RSS: {:.1f} MB".format(results["max_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="檢索流程效能測試")
+    parser.add_argument("--sizes", type=int, nargs="*", default=DEFAULT_SIZES, help="合成法律的條文數")
+    parser.add_argument("--dim", type=int, default=768, help="合成嵌入向量的維度")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--chat-turns", type=int, nargs="*", default=[10, 50, 200])
+    parser.add_argument("--no-bundled", action="store_true", help="不測試內附的LawData")
+    parser.add_argument("--output", help="將結果寫成JSON")
+    parser.add_argument("--compare", help="與之前輸出的JSON比較")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    heavy_repeats = max(3, args.repeats // 5)
+    benchmarks = {}
+    if not args.no_bundled:
+        bundled = []
+        for file_name in sorted(os.listdir(DATA_DIR)):
+            if file_name.endswith(".meta.json"):
+                law_name = file_name[:-len(".meta.json")]
+                benchmarks["bundled/" + law_name] = bench_law(law_name, DATA_DIR, args.repeats, heavy_repeats,
+                                                              rng, legacy_json=True)
+                bundled.append(load_binary(DATA_DIR, law_name))
+        benchmarks["quantization/bundled"] = bench_quantization(bundled, max(args.repeats, 100), rng)
+    for size in args.sizes:
+        tmp_dir = tempfile.mkdtemp(prefix="bench_law_")
+        try:
+            write_synthetic_store(tmp_dir, "合成法", size, args.dim)
+            benchmarks["synthetic/{}".format(size)] = bench_law("合成法", tmp_dir, args.repeats,
+                                                                heavy_repeats if size < 1000000 else 3, rng)
+            benchmarks["ann/{}".format(size)] = bench_ann(load_binary(tmp_dir, "合成法"), args.repeats, rng)
+            benchmarks["quantization/{}".format(size)] = bench_quantization([load_binary(tmp_dir, "合成法")],
+                                                                          args.repeats, rng)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    benchmarks["chat_history"] = bench_chat_history(args.chat_turns, args.repeats)
+
+    results = {"commit": git_commit(),
+               "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+               "repeats": args.repeats,
+               "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               "benchmarks": benchmarks}
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
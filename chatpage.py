@@ -1,5 +1,6 @@
 import gradio as gr
 import AIProcessor
+from ChatSessionProcessor import client_from_request, session_id_from_request
 import json
 import os
 
@@ -10,13 +11,25 @@ def chatpage_app():
         msg = gr.Textbox()
         clear = gr.ClearButton([msg, chatbot])
 
-        def respond(message, chat_history):
-            history = AIProcessor.gemini_chat(message)
-            chat_history.append(history[-1])
-            # print(chat_history)
-            return "", chat_history
+        def respond(message, chat_history, request: gr.Request):
+            chat_history.append((message, ""))
+            for answer in AIProcessor.admitted_chat_stream(message, session_id_from_request(request),
+                                                           client_from_request(request)):
+                chat_history[-1] = (message, answer)
+                yield "", chat_history
 
-        clear.click(AIProcessor.clean_chatbot)
-        msg.submit(respond, [msg, chatbot], [msg, chatbot])
+        def clear_chat(request: gr.Request):
+            AIProcessor.clean_chatbot(session_id_from_request(request))
 
+        def load_history(request: gr.Request):
+            return AIProcessor.resume_chat(session_id_from_request(request))
+
+        clear.click(clear_chat)
+        # 排隊中的請求也要佔一個worker才能顯示預估等待時間，實際呼叫模型的並行數由AIProcessor.admission限制
+        msg.submit(respond, [msg, chatbot], [msg, chatbot],
+                   concurrency_limit=AIProcessor.admission.max_concurrency + AIProcessor.admission.max_queue)
+        chat_page.load(load_history, None, chatbot)
+
+    # admission的佇列滿了之後Gradio也不再收新的請求，避免在Gradio的佇列中無限等待
+    chat_page.queue(max_size=AIProcessor.admission.max_queue)
     return chat_page
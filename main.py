@@ -4,8 +4,8 @@ import time
 import pandas as pd
 import gradio as gr
 import AIProcessor
-import json
-import os
+import AccountSysProcessor
+from ChatSessionProcessor import client_from_request, session_id_from_request
 
 
 def register(username, password):
@@ -19,27 +19,7 @@ def register(username, password):
   Returns:
     是否註冊成功
   """
-    # 檢查 users.json 檔案是否存在
-    if not os.path.exists("users.json"):
-        with open("users.json", "w") as f:
-            json.dump({}, f)
-
-    # 檢查使用者名稱是否已存在
-    with open("users.json", "r") as f:
-        users = json.load(f)
-        if username in users:
-            return False
-        if username == "" or password == "":
-            return False
-
-    # 新增帳戶資料
-    users[username] = password
-
-    # 儲存帳戶資料
-    with open("users.json", "w") as f:
-        json.dump(users, f)
-
-    return True
+    return AccountSysProcessor.get_account_store().register(username, password)
 
 
 def login(username, password):
@@ -54,24 +34,12 @@ def login(username, password):
     是否登入成功
   """
 
-    # 檢查 users.json 檔案是否存在
-    if not os.path.exists("users.json"):
-        with open("users.json", "w") as f:
-            json.dump({}, f)
-
-    # 檢查帳戶資料是否存在
-    with open("users.json", "r") as f:
-        users = json.load(f)
-        if username not in users:
-            return False
-
-    # 檢查密碼是否正確
-    return users[username] == password
+    return AccountSysProcessor.get_account_store().login(username, password)
 
 
 def submit(q_str):
-    related_articles = AIProcessor.find_related_laws(q_str)
-    return AIProcessor.gemini_answer(q_str, related_articles)
+    answer, related_articles = AIProcessor.answer_question(q_str)
+    return answer
 
 
 def main():
@@ -95,13 +63,16 @@ def main():
         btn_login = gr.Button("登入")
         lb_info = gr.Label(label="訊息", show_label=True, value="")
 
-        def login_click(_tb_username, _tb_password):
+        def login_click(_tb_username, _tb_password, request: gr.Request):
             if login(_tb_username, _tb_password):
-                return [gr.update(visible=True), gr.update(visible=False), gr.update()]
+                # 對話紀錄及提問配額以登入的帳號區分
+                history = AIProcessor.login_chat(session_id_from_request(request), _tb_username)
+                return [gr.update(visible=True), gr.update(visible=False), gr.update(), history]
             else:
                 lb_info.value = "登入失敗"
                 lb_info.render()
-                return [gr.update(), gr.update(),  gr.Label(label="訊息", show_label=True, value="登入失敗")]
+                return [gr.update(), gr.update(),  gr.Label(label="訊息", show_label=True, value="登入失敗"),
+                        gr.update()]
 
         def register_click(_tb_username, _tb_password):
             if register(_tb_username, _tb_password):
@@ -120,19 +91,25 @@ def main():
         clear = gr.ClearButton([msg, chatbot])
         btn_logout = gr.Button(value="登出")
 
-        def logout(_chatbot):
-            AIProcessor.clean_chatbot()
+        def logout(_chatbot, request: gr.Request):
+            AIProcessor.logout_chat(session_id_from_request(request))
             _chatbot = []
             return [gr.update(visible=False), gr.update(visible=True), _chatbot]
 
-        def respond(message, chat_history):
-            history = AIProcessor.gemini_chat(message)
-            chat_history.append(history[-1])
-            # print(chat_history)
-            return "", chat_history
+        def respond(message, chat_history, request: gr.Request):
+            chat_history.append((message, ""))
+            for answer in AIProcessor.admitted_chat_stream(message, session_id_from_request(request),
+                                                           client_from_request(request)):
+                chat_history[-1] = (message, answer)
+                yield "", chat_history
 
-        clear.click(AIProcessor.clean_chatbot)
-        msg.submit(respond, [msg, chatbot], [msg, chatbot])
+        def clear_chat(request: gr.Request):
+            AIProcessor.clean_chatbot(session_id_from_request(request))
+
+        clear.click(clear_chat)
+        # 排隊中的請求也要佔一個worker才能顯示預估等待時間，實際呼叫模型的並行數由AIProcessor.admission限制
+        msg.submit(respond, [msg, chatbot], [msg, chatbot],
+                   concurrency_limit=AIProcessor.admission.max_concurrency + AIProcessor.admission.max_queue)
 
     with gr.Blocks() as demo:
         with gr.Group() as view_main:
@@ -140,9 +117,10 @@ def main():
         with gr.Group(visible=False) as view_chat:
             chat_page.render()
 
-        btn_login.click(login_click, inputs=[tb_username, tb_password], outputs=[view_chat, view_main, lb_info])
+        btn_login.click(login_click, inputs=[tb_username, tb_password], outputs=[view_chat, view_main, lb_info, chatbot])
         btn_logout.click(logout, inputs=chatbot, outputs=[view_chat, view_main, chatbot])
 
+    demo.queue(max_size=AIProcessor.admission.max_queue)
     demo.launch(share=True)
 
 
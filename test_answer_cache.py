@@ -0,0 +1,31 @@
+import numpy as np
+
+from AnswerCacheProcessor import SemanticAnswerCache
+from LawDataProcessor import parse_article_references
+
+
+def _route(question: str):
+    refs = tuple(parse_article_references(question))
+    return refs, "\n".join("N" + r for r in refs)
+
+
+def test_questions_citing_different_articles_do_not_share_answers():
+    cache = SemanticAnswerCache(threshold=0.95)
+    q184 = "民法第184條規定的侵權行為要件是什麼?"
+    q185 = "民法第185條規定的侵權行為要件是什麼?"
+    e184 = np.array([1.0, 0.02, 0.0], dtype=np.float32)
+    e185 = np.array([1.0, 0.0, 0.02], dtype=np.float32)  # 只差在條號，相似度超過門檻
+    assert float(e184 @ e185) / (np.linalg.norm(e184) * np.linalg.norm(e185)) > 0.95
+
+    cache.put(q184, e184, "第184條的回答", [], {"民法": "20210120"}, _route(q184))
+    assert cache.lookup(e185, route=_route(q185)) is None
+    hit = cache.lookup(e185, route=_route(q184))
+    assert hit is not None and hit.answer == "第184條的回答"
+
+
+def test_lookup_skips_better_match_with_other_route():
+    cache = SemanticAnswerCache(threshold=0.95)
+    cache.put("第184條", np.array([1.0, 0.0]), "184", [], {}, (("184",), "N184"))
+    cache.put("第185條", np.array([1.0, 0.1]), "185", [], {}, (("185",), "N185"))
+    hit = cache.lookup(np.array([1.0, 0.0]), route=(("185",), "N185"))
+    assert hit is not None and hit.answer == "185"